@@ -0,0 +1,238 @@
+#!/usr/bin/env python2
+"""Throughput benchmarks for the conversion pipeline and the png codec.
+
+Generates a synthetic corpus in a temporary folder, times
+images.convert_image for each target format and option set,
+png.Writer.write for each bitdepth and interlace setting,
+png.Reader.read/asDirect, and images.convert_folder end to end for a
+few worker counts, then writes the timings as JSON.
+
+    python benchmark.py -o results.json
+"""
+
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+from io import BytesIO
+from optparse import OptionParser
+
+from PIL import Image, ImageDraw
+
+import png
+import images
+import shared
+
+sizes = [(320, 240), (1600, 1200)]
+modes = ['RGB', 'RGBA', 'L', 'P']
+
+convert_cases = [
+    ('JPEG', {'quality': 95}),
+    ('JPEG', {'quality': 75, 'optimize': True, 'progressive': True}),
+    ('PNG', {}),
+    ('PNG', {'optimize': True}),
+    ('PNG', {'interlace': True}),
+    ('PNG', {'colormode': 'L', 'bits': 4}),
+    ('PNG', {'colormode': 'P', 'palette': Image.ADAPTIVE, 'colors': 64}),
+    ('GIF', {'colormode': 'P'}),
+    ('Smart', {}),
+    ]
+
+
+def make_image(mode, size, seed=0):
+    """A noisy gradient with some shapes, so it neither compresses to
+    nothing nor is pure noise."""
+    width, height = size
+    im = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 32 + seed)
+    im = Image.merge('RGB', (im, noise, im.transpose(Image.FLIP_LEFT_RIGHT)))
+    draw = ImageDraw.Draw(im)
+    for i in range(8):
+        box = [width * i // 10, height * i // 12,
+               width * (i + 3) // 10, height * (i + 4) // 12]
+        draw.ellipse(box, fill=((40 * i) % 256, 255 - 30 * i, 90))
+    if mode == 'RGBA':
+        im.putalpha(Image.linear_gradient('L').resize(size))
+    elif mode == 'P':
+        im = im.convert('P', palette=Image.ADAPTIVE, colors=200)
+    elif mode != 'RGB':
+        im = im.convert(mode)
+    return im
+
+
+def make_layered(size, layers=5):
+    """Composite of several translucent layers, standing in for a
+    flattened PSD."""
+    im = Image.new('RGBA', size, (255, 255, 255, 255))
+    for i in range(layers):
+        layer = make_image('RGBA', size, seed=i)
+        layer = layer.rotate(15 * i)
+        im = Image.alpha_composite(im, layer)
+    return im
+
+
+def make_corpus(folder):
+    names = []
+    for width, height in sizes:
+        for mode in modes:
+            name = '%s_%dx%d' % (mode, width, height)
+            im = make_image(mode, (width, height))
+            if mode in ('RGB', 'L'):
+                im.save(os.path.join(folder, name + '.jpg'), quality=90)
+                names.append(name + '.jpg')
+            im.save(os.path.join(folder, name + '.png'))
+            names.append(name + '.png')
+        name = 'layered_%dx%d.tiff' % (width, height)
+        make_layered((width, height)).save(os.path.join(folder, name))
+        names.append(name)
+    return names
+
+
+def best_of(func, repeat):
+    """Return the fastest of repeat runs of func, in seconds."""
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def bench_convert_image(src_dir, dest_dir, names, repeat):
+    results = []
+    for format, options in convert_cases:
+        format_dict = dict(shared.format_dict)
+        if format != 'Smart':
+            format_dict[format] = options
+        for name in names:
+            errors = []
+            def run():
+                filename, error, output = images.convert_image(
+                    src_dir, dest_dir, format, name, format_dict, None,
+                    True, None, None, None)
+                if error:
+                    errors.append(error.strip())
+            width, height = Image.open(os.path.join(src_dir, name)).size
+            result = {'format': format, 'options': options, 'file': name,
+                      'pixels': width * height,
+                      'seconds': best_of(run, repeat)}
+            if errors:
+                # Failed conversions are timed too, but flagged
+                result['error'] = errors[0]
+            results.append(result)
+    return results
+
+
+def bench_png_write(repeat):
+    results = []
+    width, height = sizes[-1]
+    for greyscale, planes in ((True, 1), (False, 3), (False, 4)):
+        for bitdepth in (1, 2, 4, 8, 16):
+            if bitdepth < 8 and not greyscale:
+                continue
+            maxval = 2 ** bitdepth - 1
+            row = [(i * 7) % (maxval + 1) for i in range(width * planes)]
+            rows = [row] * height
+            for interlace in (False, True):
+                writer = png.Writer(width, height, greyscale=greyscale,
+                                    alpha=(planes == 4), bitdepth=bitdepth,
+                                    interlace=interlace)
+                seconds = best_of(lambda: writer.write(BytesIO(), rows),
+                                  repeat)
+                results.append({'planes': planes, 'bitdepth': bitdepth,
+                                'interlace': interlace,
+                                'size': [width, height], 'seconds': seconds})
+    return results
+
+
+def bench_png_read(repeat):
+    results = []
+    width, height = sizes[-1]
+    for planes, bitdepth in ((1, 8), (3, 8), (4, 8), (3, 16), (1, 1)):
+        maxval = 2 ** bitdepth - 1
+        row = [(i * 7) % (maxval + 1) for i in range(width * planes)]
+        for interlace in (False, True):
+            data = BytesIO()
+            png.Writer(width, height, greyscale=(planes == 1),
+                       alpha=(planes == 4), bitdepth=bitdepth,
+                       interlace=interlace).write(data, [row] * height)
+            data = data.getvalue()
+            for method in ('read', 'asDirect'):
+                def run():
+                    rows = getattr(png.Reader(bytes=data), method)()[2]
+                    for row in rows:
+                        pass
+                results.append({'method': method, 'planes': planes,
+                                'bitdepth': bitdepth, 'interlace': interlace,
+                                'size': [width, height],
+                                'seconds': best_of(run, repeat)})
+    return results
+
+
+def bench_convert_folder(src_dir, dest_dir, worker_counts, repeat):
+    results = []
+    for format in ('JPEG', 'PNG'):
+        for workers in worker_counts:
+            def run():
+                images.convert_folder(src_dir, dest_dir, format,
+                                      clear_dest=True, workers=workers)
+            results.append({'format': format, 'workers': workers,
+                            'files': len(images.find_images(src_dir)),
+                            'seconds': best_of(run, repeat)})
+    return results
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', default='-',
+                      help='file to write the JSON results to')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='runs per measurement, the fastest is kept')
+    parser.add_option('-w', '--workers', default='1,2,4',
+                      help='comma separated worker counts for convert_folder')
+    parser.add_option('--only', default=None,
+                      help='comma separated subset of: convert_image, '
+                           'png_write, png_read, convert_folder')
+    options, args = parser.parse_args(argv)
+    only = options.only.split(',') if options.only else None
+
+    work_dir = tempfile.mkdtemp(prefix='scbench')
+    try:
+        src_dir = os.path.join(work_dir, 'src')
+        dest_dir = os.path.join(work_dir, 'dest')
+        os.makedirs(src_dir)
+        os.makedirs(dest_dir)
+        names = make_corpus(src_dir)
+
+        results = {'python': sys.version.split()[0],
+                   'platform': platform.platform(),
+                   'numpy': png.numpy is not None,
+                   'repeat': options.repeat}
+        if not only or 'convert_image' in only:
+            results['convert_image'] = bench_convert_image(
+                src_dir, dest_dir, names, options.repeat)
+        if not only or 'png_write' in only:
+            results['png_write'] = bench_png_write(options.repeat)
+        if not only or 'png_read' in only:
+            results['png_read'] = bench_png_read(options.repeat)
+        if not only or 'convert_folder' in only:
+            worker_counts = [int(n) for n in options.workers.split(',')]
+            results['convert_folder'] = bench_convert_folder(
+                src_dir, dest_dir, worker_counts, options.repeat)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if options.output == '-':
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+    else:
+        with open(options.output, 'wt') as outfile:
+            json.dump(results, outfile, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,20 @@
 from __future__ import division
 
-import sys
 import os
-import re
-import traceback
+import time
+import zlib
+import struct
+import cPickle
 import tempfile
-from shutil import rmtree, make_archive
+import traceback
 from io import BytesIO
+from collections import OrderedDict
+from array import array
 from StringIO import StringIO
-from itertools import izip_longest
-from multiprocessing import Pool
-from functools import partial
+from itertools import izip_longest, count
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from PIL import Image, ImageChops
 import PIL.PngImagePlugin
@@ -22,23 +26,104 @@ Image._initialized=2
 
 import png
 from psd_tools import PSDImage
+from psd_tools.constants import ColorMode, ImageResourceID
 
 import shared
 import rename
+import scheduler
+from manifest import Manifest, settings_hash, source_state
+
+# Tasks queued per worker process by convert_folder
+tasks_per_worker = 2
+# Small images are grouped into tasks of about this many seconds, but
+# no more than batch_limit images
+batch_seconds = 0.05
+batch_limit = 64
+# Decoded bytes converted per second, until the first tasks are timed
+default_rate = 20e6
+# Copies of the decoded image a conversion may hold at once: the image,
+# a converted or resized copy and the encoder's buffers
+memory_copies = 3
+# Stored rather than deflated when archiving
+compressed_extensions = ['.jpg', '.jpeg', '.png', '.gif']
+# Id and settings of the run a worker process last converted for, see
+# load_config
+run_id = None
+run_config = None
+# Ids of the runs of this process
+run_ids = count()
+# Files at least this big are ordered by their decoded size, read from
+# their header; for those a guess could be far out, and the header read
+# costs little next to their conversion
+probe_size = 1 << 20
+# Rough decoded bytes per byte of file, to order and batch the smaller
+# ones without opening them
+expansion_ratios = {'.jpg': 10, '.jpeg': 10, '.png': 3, '.gif': 4}
+
+
+# Latest Smart verdicts of this process, keyed on the file and the check
+# settings; a worker outlives many runs, so only the most recent are kept
+grayscale_cache = OrderedDict()
+grayscale_cache_size = 64
+# Longest side of the preview is_grayscale looks at before the full image
+sample_size = 64
 
 
-def is_grayscale(im):
-    gray_im = im.convert('L')
-    if 'RGB' in im.mode:
-        gray_im = gray_im.convert(im.mode)
-    diff = ImageChops.difference(gray_im, im)
+def is_grayscale(im, tolerance=0, sampled=False):
+    """Return whether the colour bands of im differ by at most tolerance
+    everywhere.  A small preview is checked first so most colour images
+    are rejected at once; if sampled is true the preview decides for
+    grey ones too, otherwise the whole image is checked.  Alpha is
+    ignored."""
+    if im.mode in ('1', 'L', 'LA', 'La', 'I', 'F') or im.mode.startswith('I;'):
+        return True
+    if im.mode == 'LAB':
+        # Grey where a and b are neutral; laid out so bands_within
+        # compares each of them with 128
+        lightness, a, b = im.split()
+        im = Image.merge('RGB', (a, Image.new('L', im.size, 128), b))
+    elif im.getbands()[: 3] != ('R', 'G', 'B'):
+        # P, CMYK, YCbCr and so on
+        im = im.convert('RGB')
     
-    for color in diff.getdata():
-        if color != 0 and color[: 3] != (0, 0, 0):
+    sample = im
+    if max(im.size) > sample_size:
+        scale = sample_size / max(im.size)
+        sample = im.resize((max(1, int(im.size[0] * scale)),
+                            max(1, int(im.size[1] * scale))), Image.NEAREST)
+    if not bands_within(sample, tolerance):
+        return False
+    return sampled or sample is im or bands_within(im, tolerance)
+
+
+def bands_within(im, tolerance):
+    red, green, blue = im.split()[: 3]
+    for diff in (ImageChops.difference(red, green),
+                 ImageChops.difference(green, blue)):
+        if tolerance:
+            if diff.getextrema()[1] > tolerance:
+                return False
+        elif diff.getbbox() is not None:
             return False
     return True
 
 
+def cached_is_grayscale(filepath, im, tolerance=0, sampled=False):
+    try:
+        st = os.stat(filepath)
+        key = (filepath, st.st_size, st.st_mtime, tolerance, sampled)
+    except OSError:
+        return is_grayscale(im, tolerance, sampled)
+    if key in grayscale_cache:
+        grayscale = grayscale_cache.pop(key)
+    else:
+        grayscale = is_grayscale(im, tolerance, sampled)
+        if len(grayscale_cache) >= grayscale_cache_size:
+            grayscale_cache.popitem(last=False)
+    grayscale_cache[key] = grayscale
+    return grayscale
+
+
 def prepare_dir(dest_dir, clear_dest=False):
     if clear_dest:
         try:
@@ -57,7 +142,7 @@ def prepare_dir(dest_dir, clear_dest=False):
         os.makedirs(dest_dir)
 
 
-def convert_image(src_dir, dest_dir, format, filename, format_dict, rename_dict,
+def convert_image(src_dir, dest_dir, format, filename, format_dict, new_name,
                   extensions, size, resize_filter, maintain_ratio):
     try:
         name, ext = os.path.splitext(filename)
@@ -66,12 +151,22 @@ def convert_image(src_dir, dest_dir, format, filename, format_dict, rename_dict,
         filepath = os.path.join(src_dir, filename)
         if ext == '.psd':
             psd = PSDImage.load(filepath)
-            im = psd.as_PIL()
+            im = None
+            if size:
+                im = psd_thumbnail(psd, size, maintain_ratio)
+            if im is None:
+                im = psd.as_PIL()
         else:
             im = Image.open(filepath)
+            if im.format == 'JPEG':
+                draft_jpeg(im, format_dict.get(format, {}), size,
+                           maintain_ratio)
 
         if format == 'Smart':
-            if is_grayscale(im):
+            smart_options = format_dict.get('Smart', {})
+            if cached_is_grayscale(filepath, im,
+                                   smart_options.get('tolerance', 0),
+                                   smart_options.get('sampled', False)):
                 format = 'PNG'
             else:
                 format = 'JPEG'
@@ -91,15 +186,13 @@ def convert_image(src_dir, dest_dir, format, filename, format_dict, rename_dict,
             im = new_im.convert('RGB')
             
         if colormode is not None and im.mode != colormode:
-            im.draft(colormode, im.size)
             if (im.mode == 'RGBA' and colormode == 'P' and
                 options.get('transparent')):
                 if format != 'PNG':
                     im = RGBA_to_P(im, options)
                 else:
-                    im = im.convert('RGB')
-                    im = im.convert('P', palette=Image.ADAPTIVE,
-                                    colors=options.get('colors', 256))
+                    im = quantize_RGBA(im, options.get('colors', 256),
+                                       options.get('alpha_dither'))
             elif colormode == 'P':
                 convert_options = {
                     'dither': options.get('dither',
@@ -123,139 +216,536 @@ def convert_image(src_dir, dest_dir, format, filename, format_dict, rename_dict,
                 else:
                     im = im.resize(size, resize_filter)
             
-            if rename_dict:
-                name = rename_dict.get(filename)
-            dest_path = os.path.join(dest_dir, name)
+            if new_name is not None:
+                name = new_name
 
-            if (rename_dict is None) or extensions:
+            if (new_name is None) or extensions:
                 new_ext = shared.extension_dict.get(format,
                                                     '.' + format.lower())
-                dest_path += new_ext
-                
-            if (options.get('interlace') or options.get('bits', 8) != 8
-                or options.get('optimize')):
-                save_as_PNG(im, dest_path, options)
-            else:
-                im.save(dest_path, format, **options)
+                name += new_ext
+
+            if dest_dir is None:
+                # Archive mode, the parent process writes the zip
+                outfile = BytesIO()
+                save_image(im, outfile, format, options)
+                return filename, None, (name, outfile.getvalue())
+            save_image(im, os.path.join(dest_dir, name), format, options)
+            return filename, None, (name, None)
     except BaseException as e:
-        return filename, e
-    return filename, None
+        # Send back the message rather than the exception, which may
+        # not survive being pickled
+        return filename, ''.join(traceback.format_exception_only(type(e),
+                                                                 e)), None
+    return filename, None, None
+
+
+def resized_size(im_size, size, maintain_ratio):
+    """Return the size im_size is resized to, the same way as thumbnail
+    when maintain_ratio is true."""
+    if not maintain_ratio:
+        return size
+    x, y = im_size
+    if x > size[0]:
+        y = int(max(y * size[0] / x, 1))
+        x = int(size[0])
+    if y > size[1]:
+        x = int(max(x * size[1] / y, 1))
+        y = int(size[1])
+    return x, y
+
+
+def draft_jpeg(im, options, size, maintain_ratio):
+    """Have the JPEG decoder do what it can of the colour conversion and
+    resize.  It scales by 1/2, 1/4 or 1/8, so this only helps when the
+    target is at most half the size of the image."""
+    mode = None
+    if options.get('colormode') == 'L' and not options.get('transparent'):
+        mode = 'L'
+    draft_size = None
+    if size:
+        width, height = resized_size(im.size, size, maintain_ratio)
+        if width * 2 <= im.size[0] and height * 2 <= im.size[1]:
+            draft_size = width, height
+    if mode or draft_size:
+        # Only the first draft call counts
+        im.draft(mode, draft_size)
+
+
+def psd_thumbnail(psd, size, maintain_ratio):
+    """Return the JPEG thumbnail Photoshop stores in psd, if it is at
+    least as big as the resized image, otherwise None."""
+    header = psd.header
+    # The thumbnail is RGB without alpha, so any extra channel, which
+    # psd_tools takes as transparency, rules it out
+    channels = {ColorMode.RGB: 3, ColorMode.GRAYSCALE: 1}
+    if header.number_of_channels != channels.get(header.color_mode):
+        return None
+    width, height = resized_size((header.width, header.height), size,
+                                 maintain_ratio)
+    for block in psd.decoded_data.image_resource_blocks:
+        if block.resource_id != ImageResourceID.THUMBNAIL_RESOURCE:
+            continue
+        # 28 byte header: format, width, height, ... then a JFIF image
+        thumb_format, thumb_width, thumb_height = struct.unpack(
+            '>3I', block.data[: 12])
+        if (thumb_format == 1 and thumb_width >= width and
+            thumb_height >= height):
+            im = Image.open(BytesIO(block.data[28:]))
+            if header.color_mode == ColorMode.GRAYSCALE:
+                im = im.convert('L')
+            return im
+    return None
+
+
+def save_image(im, outfile, format, options):
+    if format == 'PNG' and options.get('bits', 8) == 8:
+        background = options.get('background')
+        im = reduce_image(im, keep_color=(not options.get('transparent') and
+                                          background is not None and
+                                          len(set(background)) > 1))
+    if format == 'PNG' and (options.get('interlace') or
+                            options.get('bits', 8) != 8 or
+                            options.get('optimize') or
+                            palette_alpha(im)):
+        # png.Writer also writes the alpha of palette entries
+        save_as_PNG(im, outfile, options)
+        return
+    if format == 'PNG' and im.mode == 'P':
+        options = dict(options, bits=palette_bitdepth(im.getextrema()[1] + 1))
+    im.save(outfile, format, **options)
             
 
 class Stats(object):
     image_num = 0
     image_count = 0
 
-def convert_folder(src_dir, dest_dir, format='JPEG', archive=False,
-                   clear_dest=False, callback=True, **kwargs):
-    err_log = StringIO()
-    
-    prepare_dir(dest_dir, clear_dest)
-    if archive:
-        old_dest = dest_dir
-        dest_dir = tempfile.mkdtemp()
-
-    pool = Pool()
 
+def find_images(src_dir):
     image_files = []
     for filename in os.listdir(src_dir):
         name, ext = os.path.splitext(filename)
-        ext = ext.lower()
-        
-        if ext in shared.filetypes:
+        if ext.lower() in shared.filetypes:
             image_files.append(filename)
+    return sorted(image_files, key=rename.sortkey)
 
-    image_files = sorted(image_files, key=rename.sortkey)
 
-    stats = Stats()
-    stats.image_num = len(image_files)
-    stats.image_count = 0
-    rename.image_num = stats.image_num
-    
+def read_dimensions(filepath):
+    """Return (width, height, bands) from the header of filepath, without
+    decoding it."""
+    if os.path.splitext(filepath)[1].lower() == '.psd':
+        with open(filepath, 'rb') as infile:
+            header = infile.read(26)
+        (signature, version, channels, height, width, depth,
+         mode) = struct.unpack('>4sH6xHIIHH', header)
+        if signature != b'8BPS':
+            raise IOError('not a PSD file')
+        return width, height, channels * max(depth // 8, 1)
+    im = Image.open(filepath)
+    return im.size + (len(im.getbands()),)
+
+
+def estimate_cost(filepath):
+    """Rough cost of converting filepath, as the size of the decoded
+    image in bytes, guessed from the size of the file."""
+    try:
+        file_size = os.path.getsize(filepath)
+    except OSError:
+        return 0
+    ext = os.path.splitext(filepath)[1].lower()
+    return file_size * expansion_ratios.get(ext, 1)
+
+
+def decoded_size(filepath):
+    """Size in bytes of filepath once decoded, from its header.  Falls
+    back on estimate_cost for files whose header can't be read."""
+    try:
+        width, height, bands = read_dimensions(filepath)
+    except Exception:
+        return estimate_cost(filepath)
+    return width * height * bands
+
+
+def physical_memory():
+    """Bytes of physical memory, None if that can't be found."""
+    if os.name == 'nt':
+        # No sysconf on Windows
+        import ctypes
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+        return None
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def memory_budget(memory_limit=0):
+    """Bytes that concurrent conversions may use: memory_limit MB, or
+    with 0 half of the physical memory.  None if that can't be found."""
+    if memory_limit:
+        return memory_limit << 20
+    memory = physical_memory()
+    if memory is None:
+        return None
+    return memory // 2
+
+
+def encoder_threads():
+    """Threads to encode an image on, in png.Writer and optimize_PNG: one
+    per core, but in the workers of convert_folder one plus one for each
+    core no worker is busy on.  So a big image alone in a folder, or the
+    last ones of a batch, use the cores the other workers are done
+    with."""
+    free = scheduler.free_cores()
+    if free is None:
+        return cpu_count()
+    return 1 + free
+
+
+def init_worker():
+    """Pool initializer, loads everything a conversion needs before the
+    first task arrives."""
+    Image._initialized = 2
+    for format in ('JPEG', 'PNG', 'GIF', 'BMP', 'TIFF'):
+        Image.new('RGB', (1, 1)).save(BytesIO(), format)
+
+
+def load_config(run):
+    """Make the settings of run, a (run id, config file) pair, the
+    run_config of this worker.  The file is only read by the first task
+    of the run a worker gets."""
+    global run_id, run_config
+    if run[0] != run_id:
+        with open(run[1], 'rb') as config_file:
+            run_config = cPickle.load(config_file)
+        run_id = run[0]
+
+
+def convert_task(filename, new_name):
+    """Converts filename with the run_config of the worker."""
+    c = run_config
+    return convert_image(c['src_dir'], c['dest_dir'], c['format'], filename,
+                         c['format_dict'], new_name, c['extensions'],
+                         c['size'], c['resize_filter'], c['maintain_ratio'])
+
+
+def convert_batch(run, batch):
+    """Pool task, runs convert_task with the settings of run for each
+    (filename, new_name) in batch.  Returns the results, the
+    source_state of each source for the manifest (None if the run has
+    none or the source can't be read) and the seconds they took."""
+    start = time.time()
+    load_config(run)
+    results = []
+    states = []
+    for filename, new_name in batch:
+        state = None
+        if run_config['manifest']:
+            try:
+                state = source_state(os.path.join(run_config['src_dir'],
+                                                  filename))
+            except (IOError, OSError):
+                pass
+        states.append(state)
+        results.append(convert_task(filename, new_name))
+    return results, states, time.time() - start
+
+
+def rename_template():
+    """Return the compiled rename pattern, None if not renaming.  Raises
+    rename.RenameError if the pattern is not valid."""
     if shared.options.get('rename'):
-        rename_dict = {}
-        for counter, filename in enumerate(image_files):
-            name, ext = os.path.splitext(filename)
-            replace = partial(rename.replace,
-                              {'ext': ext, 'name': name, 'n': counter})
-            rename_dict[filename] = re.sub('<(.*?)>', replace,
-                                           shared.options.get('renameText', ''))
+        return rename.Template(shared.options.get('renameText', ''))
+    return None
+
+
+def iter_convert_folder(src_dir, dest_dir, image_files, format='JPEG',
+                        pool=None, workers=None, manifest=None,
+                        memory_limit=0, **kwargs):
+    """Convert image_files from src_dir, yielding (filename, error,
+    output) as the conversions finish.  error is None or the error
+    message.  output is the (name, data) of the converted image, where
+    data is None unless dest_dir is None, in which case nothing is
+    written.  output is None for failed and skipped images.
+
+    If manifest is given, images it has as up to date are skipped
+    without being converted, and it is updated with the rest.
+
+    The images that look most costly to convert are started first, going
+    by the header of files of at least probe_size and by estimate_cost
+    for the rest, so a few big files don't end up running alone at the
+    end of the batch.  Results come back in the order they finish, but
+    images are still numbered by rename in image_files order.
+
+    Tasks are only built as workers free up, with at most
+    tasks_per_worker tasks queued for each worker, so memory use does
+    not grow with the size of the folder.  The settings of the run are
+    read by each worker once, from a file named in the tasks, and each
+    task is otherwise just a list of filenames and their new names.
+    Small images are grouped so that a task takes about batch_seconds,
+    going by how fast the finished ones went, and results are still
+    yielded one per image.
+
+    Conversions are only started while their estimated memory use,
+    memory_copies times decoded_size, fits in memory_budget(memory_limit)
+    along with those already running; big images wait while smaller
+    ones carry on.
+
+    pool is a scheduler.WorkerPool to run the conversions in; without
+    one a pool of workers processes is started and stopped again.
+    The pool is kept whatever the settings of the run.  Images whose
+    worker process dies, or whose task fails, are given as errors.
+    """
+    template = rename_template()
+    if template is not None:
+        # Any error in the pattern is raised here, before converting
+        rename_dict = template.rename(image_files)
     else:
         rename_dict = None
 
-    def convert_callback(results):
-        filename, exception = results
-        if exception:
-            err_log.write('Failed to process ' + filename)
-            error = ''.join(traceback.format_exception_only(type(exception),
-                                                            exception))
-            err_log.write(error)
-            stats.image_num -= 1
-        else:
-            stats.image_count += 1
-        if stats.image_count >= stats.image_num:
-            err_log_str = err_log.getvalue()
-            if err_log_str:
-                print(err_log_str)
-        filename += ' (%d/%d)' % (stats.image_count, stats.image_num)
-            
-        callback(filename, exception)
-        
+    if shared.options.get('resize'):
+        size = (shared.options.get('resizeWidth', 1000),
+                shared.options.get('resizeHeight', 1000))
+        resize_filter = shared.options.get('resizeFilter', Image.NEAREST)
+        maintain_ratio = shared.options.get('maintainRatio', False)
+    else:
+        size = None
+        resize_filter = None
+        maintain_ratio = None
+
+    settings = {}
+    if manifest is not None:
+        run_settings = (format, shared.format_dict if format == 'Smart'
+                        else shared.format_dict.get(format), size,
+                        resize_filter, maintain_ratio,
+                        shared.options.get('extensions'))
+        pending = []
+        for filename in image_files:
+            settings[filename] = settings_hash(
+                run_settings, rename_dict and rename_dict.get(filename))
+            src_path = os.path.join(src_dir, filename)
+            if manifest.is_current(src_path, settings[filename]):
+                yield filename, None, None
+            else:
+                pending.append(filename)
+        image_files = pending
+
+    # Only the settings this format uses
+    used_formats = ('Smart', 'JPEG', 'PNG') if format == 'Smart' else (format,)
+    config = {'src_dir': src_dir, 'dest_dir': dest_dir, 'format': format,
+              'format_dict': dict((key, shared.format_dict[key])
+                                  for key in used_formats
+                                  if key in shared.format_dict),
+              'extensions': shared.options.get('extensions'), 'size': size,
+              'resize_filter': resize_filter,
+              'maintain_ratio': maintain_ratio,
+              'manifest': manifest is not None}
+
+    # Decoded sizes read so far, kept until weigh has used them
+    decoded = {}
+    def decoded_cost(filename):
+        if filename not in decoded:
+            decoded[filename] = decoded_size(os.path.join(src_dir,
+                                                          filename))
+        return decoded[filename]
+
+    # Longest job first; sorted is stable, so ties keep their order
+    costs = {}
     for filename in image_files:
+        src_path = os.path.join(src_dir, filename)
         try:
-            if shared.options.get('resize'):
-                size = (shared.options.get('resizeWidth', 1000),
-                        shared.options.get('resizeHeight', 1000))
-                resize_filter = shared.options.get('resizeFilter',
-                                                   Image.NEAREST)
-                maintain_ratio = shared.options.get('maintainRatio', False)
+            probe = os.path.getsize(src_path) >= probe_size
+        except OSError:
+            probe = False
+        costs[filename] = (decoded_cost(filename) if probe
+                           else estimate_cost(src_path))
+    image_files = sorted(image_files, key=costs.get, reverse=True)
+
+    # Cost and worker seconds of the finished tasks
+    done = {'cost': 0, 'seconds': 0}
+
+    def tasks():
+        batch = []
+        batch_cost = 0
+        for filename in image_files:
+            if done['seconds'] > 0:
+                rate = done['cost'] / done['seconds']
             else:
-                size = None
-                resize_filter = None
-                maintain_ratio = None
-
-            result = pool.apply_async(convert_image, (src_dir, dest_dir,
-                                                      format, filename,
-                                                      shared.format_dict,
-                                                      rename_dict,
-                                                      shared.options.get(
-                                                          'extensions'),
-                                                      size,
-                                                      resize_filter,
-                                                      maintain_ratio),
-                                      callback=convert_callback)
-            
-        except:
-            err_log.write('failed to process %s%s' % (name, ext))
-            err_log.write(''.join(traceback.format_exception(*sys.exc_info())))
-            pass
- 
+                rate = default_rate
+            cost = costs[filename]
+            if batch and (len(batch) >= batch_limit or
+                          (batch_cost + cost) / rate > batch_seconds):
+                yield run, batch
+                batch = []
+                batch_cost = 0
+            batch.append((filename,
+                          rename_dict and rename_dict.get(filename)))
+            batch_cost += cost
+        if batch:
+            yield run, batch
+
+    # Each worker reads the settings from the file once, rather than
+    # them being sent with every task or the pool being restarted
+    config_fd, config_path = tempfile.mkstemp(prefix='scconfig')
+    with os.fdopen(config_fd, 'wb') as config_file:
+        cPickle.dump(config, config_file, cPickle.HIGHEST_PROTOCOL)
+    run = next(run_ids), config_path
+
+    own_pool = pool is None
+    if own_pool:
+        pool = scheduler.WorkerPool(init_worker)
+    try:
+        # A batch runs one image at a time, so needs its biggest one's
+        def weigh(args):
+            weight = memory_copies * max(decoded_cost(filename)
+                                         for filename, new_name in args[1])
+            for filename, new_name in args[1]:
+                del decoded[filename]
+            return weight
+        # The task raised outside convert_image, or its worker died,
+        # most likely in a decoder or out of memory
+        def failed(args, error):
+            message = str(error) or error.__class__.__name__
+            return ([(filename, message, None)
+                     for filename, new_name in args[1]],
+                    [None] * len(args[1]), 0)
+        pool.get(workers)
+        results = scheduler.imap_bounded(pool, convert_batch, tasks(),
+                                         pool.size * tasks_per_worker,
+                                         memory_budget(memory_limit), weigh,
+                                         failed)
+        for batch_results, states, seconds in results:
+            done['cost'] += sum(costs[result[0]] for result in batch_results)
+            done['seconds'] += seconds
+            for result, state in zip(batch_results, states):
+                if manifest is not None:
+                    filename, error, output = result
+                    src_path = os.path.join(src_dir, filename)
+                    if error:
+                        manifest.discard(src_path)
+                    else:
+                        manifest.update(src_path, state, settings[filename],
+                                        output[0])
+                yield result
+    finally:
+        if own_pool:
+            pool.close()
+        os.remove(config_path)
+
+
+def convert_folder(src_dir, dest_dir, format='JPEG', archive=False,
+                   clear_dest=False, incremental=False, callback=None,
+                   **kwargs):
+    err_log = StringIO()
+    # Check the rename pattern before touching the destination
+    rename_template()
+    
+    prepare_dir(dest_dir, clear_dest)
+    manifest = None
     if archive:
-        archive_name = os.path.join(old_dest, os.path.basename(src_dir))
-        make_archive(archive_name, 'zip', dest_dir)
-        rmtree(dest_dir)
+        archive_name = os.path.join(dest_dir, os.path.basename(src_dir))
+        zip_file = ZipFile(archive_name + '.zip', 'w', ZIP_DEFLATED,
+                           allowZip64=True)
+        dest_dir = None
+    elif incremental:
+        manifest = Manifest(dest_dir, fresh=clear_dest)
+
+    image_files = find_images(src_dir)
+    stats = Stats()
+    stats.image_num = len(image_files)
+    stats.image_count = 0
+    errors = []
+
+    try:
+        for filename, error, output in iter_convert_folder(src_dir, dest_dir,
+                                                           image_files, format,
+                                                           manifest=manifest,
+                                                           **kwargs):
+            if output and output[1] is not None:
+                name, data = output
+                ext = os.path.splitext(name)[1].lower()
+                # Recompressing these would only cost time
+                compress_type = (ZIP_STORED if ext in compressed_extensions
+                                 else ZIP_DEFLATED)
+                zip_file.writestr(name, data, compress_type)
+            if error:
+                errors.append((filename, error))
+                stats.image_num -= 1
+            else:
+                stats.image_count += 1
+            if callback:
+                callback(filename + ' (%d/%d)' % (stats.image_count,
+                                                  stats.image_num), error)
+    finally:
+        if archive:
+            zip_file.close()
+        if manifest is not None:
+            manifest.save()
+
+    # Conversions finish out of order, log them in folder order
+    for filename, error in sorted(errors,
+                                  key=lambda item: rename.sortkey(item[0])):
+        err_log.write('Failed to process ' + filename)
+        err_log.write(error)
+    err_log_str = err_log.getvalue()
+    if err_log_str:
+        print(err_log_str)
 
 
-class PilImageToPyPngAdapter:
-    # taken from GitHub
+class PilImageToPyPngAdapter(object):
+    """Row source for png.Writer that reads the image's raw bytes.
+
+    Rows are sliced out of ``tobytes()`` strips, so each row is an
+    ``array('B')`` holding one byte per sample and nothing is done per
+    pixel in Python.  Rows can be iterated in order or indexed.
+    """
+    strip_rows = 64
+
     def __init__(self, im):
+        if im.mode == '1':
+            # tobytes() packs bilevel images; the writer wants 0/255 values
+            im = im.convert('L')
         self.im = im
-        self.iml = im.load()
+        self.width, self.height = im.size
+        self.row_bytes = self.width * len(im.getbands())
+        self.strip_top = None
+        self.strip = None
 
     def __len__(self):
-        return self.im.size[1]
+        return self.height
+
+    def load_strip(self, top):
+        bottom = min(top + self.strip_rows, self.height)
+        strip = self.im.crop((0, top, self.width, bottom))
+        self.strip = array('B', strip.tobytes())
+        self.strip_top = top
 
     def __getitem__(self, row):
-        out = []
-        for col in range(self.im.size[0]):
-            px = self.iml[col, row]
-            if hasattr(px, '__iter__'):
-                #Multi-channel image
-                out.extend(px)
-            else:
-                #Single channel image
-                out.append(px)
-        return out
+        if row < 0:
+            row += self.height
+        if not 0 <= row < self.height:
+            raise IndexError('row index out of range')
+        if (self.strip_top is None or
+            not self.strip_top <= row < self.strip_top + self.strip_rows):
+            self.load_strip(row - row % self.strip_rows)
+        offset = (row - self.strip_top) * self.row_bytes
+        return self.strip[offset:offset + self.row_bytes]
+
+    def __iter__(self):
+        for row in range(self.height):
+            yield self[row]
 
 
 def to_greyscale(r, g, b):
@@ -270,6 +760,28 @@ def grouper(iterable, n, fillvalue=None):
 
 
 def save_as_PNG(im, filename, options):
+    im, writer_args = png_writer_args(im, options)
+    if hasattr(filename, 'write'):
+        outfile = filename
+    else:
+        outfile = open(filename, 'wb')
+    try:
+        if options.get('optimize'):
+            outfile.write(optimize_PNG(im, writer_args,
+                                       options.get('optimize_attempts', 4)))
+        else:
+            im, writer_args = reduce_PNG_image(im, writer_args)
+            write_PNG(im, outfile, writer_args)
+    finally:
+        if outfile is not filename:
+            outfile.close()
+
+
+def png_writer_args(im, options):
+    """Return im in a mode png.Writer can take, along with the Writer
+    arguments for it."""
+    if im.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+        im = im.convert('RGBA' if 'A' in im.getbands() else 'RGB')
     colormode = options.get('colormode')
     transparent = options.get('transparent')
     greyscale = ('L' in im.mode or '1' in im.mode)
@@ -277,10 +789,7 @@ def save_as_PNG(im, filename, options):
     background = None if transparent else options.get('background')
     if greyscale and background:
         background = to_greyscale(*background)
-    palette = im.getpalette()
-    
-    if palette:
-        palette = grouper(palette, 3)
+    palette = png_palette(im)
 
     writer_args = {
         'size': im.size,
@@ -292,13 +801,349 @@ def save_as_PNG(im, filename, options):
         'background':  background,
         'compression': 9 if options.get('optimize') else -1,
         'interlace': options.get('interlace'),
+        'filter_type': ('sum' if options.get('optimize') and bitdepth == 8
+                        and not palette else 0),
+        # The writer only spreads big images over the threads
+        'threads': encoder_threads(),
     }
     if not palette and bitdepth != 8:
-        im = Image.eval(im, lambda x: (x * (2 ** bitdepth)) / 256)
+        # PNG only has low bit depths for plain greyscale; other images
+        # keep 8 bits a sample and record the real depth with sBIT
+        native = im.mode in ('1', 'L')
+        im = reduce_bits(im, bitdepth, options.get('bits_dither', Image.NONE),
+                         scale=not native)
+        if not native:
+            writer_args['bitdepth'] = 8
+            writer_args['sbit'] = bitdepth
+    return im, writer_args
+
+
+def reduce_bits(im, bits, dither=Image.NONE, scale=False):
+    """Return im with every sample reduced to bits bits, that is to
+    0 to 2 ** bits - 1, or if scale is true to that many evenly spaced
+    values from 0 to 255.  dither is Image.NONE, Image.ORDERED or
+    Image.FLOYDSTEINBERG; all of them are done by PIL a band at a
+    time."""
+    if im.mode == '1':
+        im = im.convert('L')
+    levels = 2 ** bits
+    if dither == Image.FLOYDSTEINBERG:
+        # Quantizing to a palette of the levels diffuses the error
+        palette_im = Image.new('P', (1, 1))
+        palette = []
+        for level in range(levels):
+            palette.extend([level * 255 // (levels - 1)] * 3)
+        # Nothing grey is nearer to the unused entries than to a level
+        palette.extend([255, 0, 255] * (256 - levels))
+        palette_im.putpalette(palette)
+        bands = []
+        for band in im.split():
+            band = band.convert('RGB').quantize(palette=palette_im)
+            bands.append(Image.frombytes('L', im.size, band.tobytes()))
+        im = Image.merge(im.mode, bands)
+        lut = [min(value, levels - 1) for value in range(256)]
+    elif dither == Image.ORDERED:
+        # Thresholds spread over one step between levels
+        step = 255 / (levels - 1)
+        tile = Image.new('L', (4, 4))
+        tile.putdata([int((2 * value + 1) * step / 32)
+                      for value in bayer_matrix])
+        tile = tile_image(tile, im.size)
+        tile = Image.merge(im.mode, [tile] * len(im.getbands()))
+        im = ImageChops.add(im, tile)
+        lut = [value * (levels - 1) // 255 for value in range(256)]
+    else:
+        lut = [value * levels // 256 for value in range(256)]
+    if scale:
+        lut = [level * 255 // (levels - 1) for level in lut]
+    return im.point(lut * len(im.getbands()))
+
+
+def write_PNG(im, outfile, writer_args):
     png_writer = png.Writer(**writer_args)
+    rows, packed = png_rows(png_writer, im)
+    png_writer.write_passes(outfile, rows, packed)
+
+
+def png_rows(png_writer, im):
+    """Return the rows of im to give png_writer.write_passes or
+    iter_filtered, and whether they are packed."""
+    rows = PilImageToPyPngAdapter(im)
+    if png_writer.interlace:
+        return png_writer.rows_scanlines_interlace(rows), False
+    # At 8 bits rows are already packed bytes, skip the per-value extend
+    return rows, png_writer.bitdepth == 8
+
+
+# Filter types tried by optimize_PNG and the zlib strategies each is
+# compressed with, cheapest and most promising first.  The image is
+# only filtered once for each filter type.
+png_strategies = [(0, [zlib.Z_DEFAULT_STRATEGY, png.Z_RLE]),
+                  ('sum', [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED,
+                           png.Z_RLE, zlib.Z_HUFFMAN_ONLY]),
+                  (4, [zlib.Z_DEFAULT_STRATEGY]),
+                  (1, [zlib.Z_DEFAULT_STRATEGY]),
+                  (2, [zlib.Z_DEFAULT_STRATEGY])]
+# Those that make sense for palette and low bit depth images
+packed_png_strategies = [(0, [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED,
+                              png.Z_RLE]),
+                         ('sum', [zlib.Z_DEFAULT_STRATEGY])]
+
+
+def optimize_PNG(im, writer_args, attempts=4, threads=None):
+    """Encode im with each lossless reduction of it, each filter type
+    of png_strategies and each zlib strategy for it, most promising
+    first, and return the smallest PNG data.  At most attempts
+    compressions are tried, 0 means all of them; they are spread over
+    threads threads, encoder_threads() if None, while the next filter
+    type is applied."""
+    groups = []
+    for candidate, args in reduced_PNG_images(im, writer_args):
+        packed = args['palette'] or args['bitdepth'] < 8
+        for filter_type, strategies in (packed_png_strategies if packed
+                                        else png_strategies):
+            groups.append((candidate, dict(args, filter_type=filter_type,
+                                           compression=9, threads=1),
+                           strategies))
+    if attempts:
+        limited = []
+        for candidate, args, strategies in groups:
+            if attempts <= 0:
+                break
+            limited.append((candidate, args, strategies[:attempts]))
+            attempts -= len(strategies)
+        groups = limited
+
+    def compress(args, filtered):
+        outfile = BytesIO()
+        png.Writer(**args).write_filtered(outfile, filtered)
+        return outfile.getvalue()
+
+    if threads is None:
+        threads = encoder_threads()
+    thread_pool = ThreadPool(threads) if threads > 1 else None
+    try:
+        results = []
+        for candidate, args, strategies in groups:
+            png_writer = png.Writer(**args)
+            filtered = list(png_writer.iter_filtered(
+                *png_rows(png_writer, candidate)))
+            for strategy in strategies:
+                task = (dict(args, strategy=strategy), filtered)
+                if thread_pool is None:
+                    results.append(compress(*task))
+                else:
+                    results.append(thread_pool.apply_async(compress, task))
+        if thread_pool is not None:
+            results = [result.get() for result in results]
+    finally:
+        if thread_pool is not None:
+            thread_pool.terminate()
+    # The first of the smallest, so the result doesn't depend on timing
+    return min(results, key=len)
+
+
+def reduced_PNG_images(im, writer_args):
+    """Yield (image, writer_args) for the smallest lossless
+    representation of im and, if that is different, im itself."""
+    yield reduce_PNG_image(im, writer_args)
+    if writer_args['bitdepth'] == 8 and not writer_args.get('sbit'):
+        yield im, writer_args
+
+
+def reduce_PNG_image(im, writer_args):
+    """Return im and writer_args for the smallest lossless
+    representation of im: see reduce_image, and trimmed palettes and
+    greyscale at 1, 2 or 4 bits when that is exact."""
+    if writer_args['bitdepth'] != 8 or writer_args.get('sbit'):
+        return im, writer_args
+    args = dict(writer_args)
+    # png_writer_args has already made it a grey level for grey images
+    background = args['background']
+    grey_background = background is None or isinstance(background, int)
+    if not args['palette']:
+        im = reduce_image(im, keep_color=(not grey_background and
+                                          len(set(background)) > 1))
+        args['alpha'] = 'A' in im.mode
+        args['greyscale'] = im.mode in ('1', 'L', 'LA')
+        if args['greyscale'] and not grey_background:
+            args['background'] = background[0]
+        elif im.mode == 'P':
+            args['background'] = None
+            args['palette'] = png_palette(im)
+
+    if args['palette']:
+        # Only keep the palette entries that are used
+        colors = im.getextrema()[1] + 1
+        args['palette'] = args['palette'][: colors]
+        args['bitdepth'] = palette_bitdepth(colors)
+    elif im.mode in ('1', 'L'):
+        if im.mode == '1':
+            im = im.convert('L')
+        colors = im.getcolors(16)
+        background = args['background']
+        if colors:
+            for bitdepth in (1, 2, 4):
+                scale = 255 // (2 ** bitdepth - 1)
+                if (all(value % scale == 0 for count, value in colors) and
+                    (background is None or background % scale == 0)):
+                    im = im.point(lambda value: value // scale)
+                    args['bitdepth'] = bitdepth
+                    if background is not None:
+                        args['background'] = background // scale
+                    break
+    args['size'] = im.size
+    return im, args
+
+
+def analyse_image(im):
+    """Return (colors, opaque, grey) for an L, LA, RGB or RGBA image:
+    its colours as getcolors gives them, or None if there are more than
+    256, whether its alpha is 255 everywhere and whether R == G == B
+    everywhere.  When there are few colours the one counting pass
+    answers everything."""
+    bands = im.getbands()
+    colors = im.getcolors(256)
+    if colors is not None:
+        pixels = [color if isinstance(color, tuple) else (color,)
+                  for count, color in colors]
+        opaque = 'A' not in bands or all(p[-1] == 255 for p in pixels)
+        grey = len(bands) < 3 or all(p[0] == p[1] == p[2] for p in pixels)
+    else:
+        opaque = 'A' not in bands or im.split()[-1].getextrema()[0] == 255
+        grey = len(bands) < 3 or is_grayscale(im)
+    return colors, opaque, grey
+
+
+def reduce_image(im, keep_color=False):
+    """Return im in the smallest mode that holds it exactly: without
+    alpha if it is opaque, L or LA if it is grey (unless keep_color)
+    and P if it has no alpha and at most 256 colours.  Bilevel and
+    palette images are returned as they are."""
+    if im.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        return im
+    colors, opaque, grey = analyse_image(im)
+    if 'A' in im.mode and opaque:
+        im = im.convert(im.mode[: -1])
+    if grey and not keep_color and im.mode in ('RGB', 'RGBA'):
+        im = im.convert('LA' if 'A' in im.mode else 'L')
+    if im.mode == 'RGB' and colors:
+        palette_im = im.convert('P', palette=Image.ADAPTIVE,
+                                colors=len(colors))
+        if not ImageChops.difference(palette_im.convert('RGB'),
+                                     im).getbbox():
+            im = palette_im
+    elif im.mode == 'RGBA' and colors:
+        im = clear_transparent(im)
+        palette_im = quantize_RGBA(im, len(colors))
+        if not ImageChops.difference(palette_im.convert('RGBA'),
+                                     im).getbbox():
+            im = palette_im
+    return im
+
+
+def png_palette(im):
+    """Return im's palette as a list of png.Writer palette entries, or
+    None."""
+    palette = im.getpalette()
+    if not palette:
+        return None
+    palette = list(grouper(palette, 3))
+    alphas = palette_alpha(im)
+    if alphas:
+        # The translucent entries come first, see quantize_RGBA
+        palette[: len(alphas)] = [color + (alpha,) for color, alpha
+                                  in zip(palette, bytearray(alphas))]
+    return palette
+
+
+def palette_alpha(im):
+    """Return the alpha of im's leading palette entries, as in a tRNS
+    chunk, or None."""
+    if im.mode != 'P':
+        return None
+    alphas = im.info.get('transparency')
+    if isinstance(alphas, bytes):
+        return alphas
+    return None
+
+
+# Spread of the ordered dither quantize_RGBA can add to alpha
+alpha_dither_step = 32
+# 4x4 Bayer threshold matrix
+bayer_matrix = [0, 8, 2, 10,
+                12, 4, 14, 6,
+                3, 11, 1, 9,
+                15, 7, 13, 5]
+
+
+def quantize_RGBA(im, colors=256, dither_alpha=False):
+    """Quantize an RGBA image to a P image of at most colors colours
+    whose palette includes alpha.  The translucent entries are put
+    first and their alpha stored as bytes in info['transparency'], as
+    PNG's tRNS chunk wants it.
+
+    If dither_alpha is true, partly transparent areas get an ordered
+    dither on alpha first, so gradients band less once the palette
+    has only a few levels of alpha."""
+    im = clear_transparent(im)
+    if dither_alpha:
+        alpha = im.split()[3]
+        tile = Image.new('L', (4, 4))
+        tile.putdata([value * alpha_dither_step // 16
+                      for value in bayer_matrix])
+        dithered = ImageChops.add(alpha, tile_image(tile, im.size),
+                                  offset=-alpha_dither_step // 2)
+        # Fully transparent and fully opaque pixels stay as they are
+        mask = alpha.point(lambda a: 255 if 0 < a < 255 else 0)
+        alpha.paste(dithered, mask=mask)
+        im.putalpha(alpha)
+    im = im.quantize(colors, method=Image.FASTOCTREE)
+
+    used = im.getextrema()[1] + 1
+    palette = bytearray(im.im.getpalette('RGBA', 'RGBA'))
+    entries = [tuple(palette[i * 4: i * 4 + 4]) for i in range(used)]
+    order = sorted(range(used), key=lambda i: entries[i][3] == 255)
+    lut = [0] * 256
+    for new_index, old_index in enumerate(order):
+        lut[old_index] = new_index
+    im = im.point(lut)
+    entries = [entries[i] for i in order]
+    im.putpalette([value for entry in entries for value in entry[: 3]])
+    im.info = {'transparency': bytes(bytearray(entry[3] for entry in entries
+                                               if entry[3] != 255))}
+    return im
+
+
+def clear_transparent(im):
+    """Return a copy of RGBA im with every fully transparent pixel set
+    to (0, 0, 0, 0), so they don't use up palette entries."""
+    im = im.copy()
+    im.paste((0, 0, 0, 0), mask=im.split()[3].point(
+        lambda a: 255 if a == 0 else 0))
+    return im
+
+
+def tile_image(tile, size):
+    """Return an image of size covered with copies of tile."""
+    im = Image.new(tile.mode, size)
+    width, height = tile.size
+    im.paste(tile, (0, 0))
+    # Double the tiled area each time
+    while width < size[0]:
+        im.paste(im.crop((0, 0, width, height)), (width, 0))
+        width *= 2
+    while height < size[1]:
+        im.paste(im.crop((0, 0, size[0], height)), (0, height))
+        height *= 2
+    return im
+
 
-    with open(filename, 'wb') as outfile:
-        png_writer.write(outfile, PilImageToPyPngAdapter(im))
+def palette_bitdepth(colors):
+    for bitdepth in (1, 2, 4):
+        if colors <= 2 ** bitdepth:
+            return bitdepth
+    return 8
 
 
 def RGBA_to_P(im, options):
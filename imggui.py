@@ -16,6 +16,8 @@ class ImagePanel(wx.Panel):
                       'Grayscale': 'L', 'Bilevel': '1'}
     palette_dict = {'Web': Image.WEB, 'Adaptive': Image.ADAPTIVE}
     dither_dict = {'Floydsteinberg': Image.FLOYDSTEINBERG, 'None': Image.NONE}
+    bits_dither_dict = {'None': Image.NONE, 'Ordered': Image.ORDERED,
+                        'Floydsteinberg': Image.FLOYDSTEINBERG}
     def __init__(self, *args, **kwargs):
         wx.Panel.__init__(self, *args, **kwargs)
         if ImagePanel.data is None:
@@ -136,8 +138,30 @@ class PngPanel(ImagePanel):
         
         optimizeCheckBox = wx.CheckBox(parent=self, label='Optimize')
         optimizeCheckBox.SetValue(self.data.get('optimize', False))
+        optimizeCheckBox.SetToolTipString('Try several ways of encoding '
+                                          'each image and keep the smallest')
+
+        labeledOptimizeAttempts = LabeledWidget(parent=self,
+                                                cls=wx.SpinCtrl,
+                                                label='Attempts', min=0,
+                                                max=20,
+                                                initial=self.data.get(
+                                                    'optimize_attempts', 4))
+        optimizeAttemptsSpin = labeledOptimizeAttempts.widget
+        optimizeAttemptsSpin.SetToolTipString('Number of encodings to try '
+                                              'for each image, 0 for all')
+        optimizeAttemptsSpin.Bind(wx.EVT_SPINCTRL,
+                                  partial(self.OnEvent,
+                                          attr='optimize_attempts',
+                                          func=optimizeAttemptsSpin.GetValue))
+        def onOptimize():
+            value = optimizeCheckBox.IsChecked()
+            labeledOptimizeAttempts.Enable(value)
+            return value
         optimizeCheckBox.Bind(wx.EVT_CHECKBOX,
-                              partial(self.OnCheckBox, attr='optimize'))
+                              partial(self.OnCheckBox, attr='optimize',
+                                      func=onOptimize))
+        onOptimize()
 
         labeledBgColor = LabeledWidget(parent=self, label='Background',
                                               cls=wx.ColourPickerCtrl)
@@ -222,6 +246,15 @@ class PngPanel(ImagePanel):
         
         self.colorsText = wx.StaticText(parent=self, label='Colors')
 
+        self.alphaDitherCheckBox = wx.CheckBox(parent=self,
+                                               label='Dither Transparency')
+        self.alphaDitherCheckBox.SetValue(self.data.get('alpha_dither', False))
+        self.alphaDitherCheckBox.SetToolTipString('Dither partly transparent '
+                                                  'areas of palette images')
+        self.alphaDitherCheckBox.Bind(wx.EVT_CHECKBOX,
+                                      partial(self.OnCheckBox,
+                                              attr='alpha_dither'))
+
         bitsChoice = wx.Choice(parent=self)
         SetupChoice(bitsChoice,
                     map(str, [1, 2, 4, 8]),
@@ -231,6 +264,15 @@ class PngPanel(ImagePanel):
                                 func=(lambda: int(bitsChoice.GetStringSelection()))))
         bitsText = wx.StaticText(parent=self, label='Bits')
 
+        bitsDitherChoice = wx.Choice(parent=self)
+        SetupChoice(bitsDitherChoice,
+                    ['None', 'Ordered', 'Floydsteinberg'],
+                    self.data.get('bits_dither'), self.bits_dither_dict)
+        bitsDitherChoice.Bind(wx.EVT_CHOICE,
+                              partial(self.OnChoice, attr='bits_dither',
+                                      edict=self.bits_dither_dict))
+        bitsDitherText = wx.StaticText(parent=self, label='Dither')
+
         self.onColormodeChoice()
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         
@@ -238,6 +280,8 @@ class PngPanel(ImagePanel):
         hSizer = wx.BoxSizer(wx.HORIZONTAL)
         hSizer.AddStretchSpacer(prop=1)
         hSizer.Add(optimizeCheckBox, flag=wx.ALIGN_CENTER)
+        AddLinearSpacer(hSizer, 5)
+        hSizer.Add(labeledOptimizeAttempts, flag=wx.ALIGN_CENTER)
         AddLinearSpacer(hSizer, 10)
         hSizer.Add(interlaceCheckBox, flag=wx.ALIGN_CENTER)
         AddLinearSpacer(hSizer, 10)
@@ -274,6 +318,8 @@ class PngPanel(ImagePanel):
         hSizer.Add(self.colorsText, flag=wx.ALIGN_CENTER)
         AddLinearSpacer(hSizer, 5)
         hSizer.Add(self.colorsChoice, flag=wx.ALIGN_CENTER)
+        AddLinearSpacer(hSizer, 15)
+        hSizer.Add(self.alphaDitherCheckBox, flag=wx.ALIGN_CENTER)
         hSizer.AddStretchSpacer(prop=1)
         self.sizer.Add(hSizer, flag=wx.ALIGN_CENTER)
         AddLinearSpacer(self.sizer, 10)
@@ -283,6 +329,10 @@ class PngPanel(ImagePanel):
         hSizer.Add(bitsText, flag=wx.ALIGN_CENTER)
         AddLinearSpacer(hSizer, 5)
         hSizer.Add(bitsChoice, flag=wx.ALIGN_CENTER)
+        AddLinearSpacer(hSizer, 15)
+        hSizer.Add(bitsDitherText, flag=wx.ALIGN_CENTER)
+        AddLinearSpacer(hSizer, 5)
+        hSizer.Add(bitsDitherChoice, flag=wx.ALIGN_CENTER)
         hSizer.AddStretchSpacer(prop=1)
         self.sizer.Add(hSizer, flag=wx.ALIGN_CENTER)
 
@@ -298,7 +348,8 @@ class PngPanel(ImagePanel):
         enabled = (mode == 'P')
         text_color = (0, 0, 0) if enabled else (130, 130, 130)
 
-        controls = (self.paletteChoice, self.ditherChoice, self.colorsChoice)
+        controls = (self.paletteChoice, self.ditherChoice, self.colorsChoice,
+                    self.alphaDitherCheckBox)
         for control in controls:
             control.Enable(enabled)
         
@@ -476,13 +527,49 @@ class GifPanel(ImagePanel):
 
 
 class SmartPanel(ImagePanel):
+    format = 'Smart'
     about = 'Converts grayscale images to PNG and color images to JPEG.'
     def __init__(self, *args, **kwargs):
         ImagePanel.__init__(self, *args, **kwargs)
         aboutText = wx.StaticText(parent=self, label=self.about)
 
+        labeledTolerance = LabeledWidget(parent=self, cls=wx.Slider,
+                                         label='Gray Tolerance',
+                                         minValue=0, maxValue=32,
+                                         style=wx.SL_HORIZONTAL)
+        toleranceSlider = labeledTolerance.widget
+        toleranceSlider.SetValue(self.data.get('tolerance', 0))
+        toleranceSlider.SetToolTipString('How far apart the color channels '
+                                         'of a gray pixel may be, for scans')
+        toleranceText = wx.StaticText(parent=self)
+        def setToleranceText():
+            tolerance = toleranceSlider.GetValue()
+            toleranceText.SetLabel(str(tolerance))
+            return tolerance
+        setToleranceText()
+        toleranceSlider.Bind(wx.EVT_SLIDER,
+                             partial(self.OnSlider, attr='tolerance',
+                                     func=setToleranceText))
+
+        sampledCheckBox = wx.CheckBox(parent=self, label='Quick Check')
+        sampledCheckBox.SetValue(self.data.get('sampled', False))
+        sampledCheckBox.SetToolTipString('Judge images by a small preview '
+                                         'instead of every pixel')
+        sampledCheckBox.Bind(wx.EVT_CHECKBOX,
+                             partial(self.OnCheckBox, attr='sampled'))
+
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         self.sizer.Add(aboutText, flag=wx.ALIGN_CENTER)
+        AddLinearSpacer(self.sizer, 10)
+
+        hSizer = wx.BoxSizer(wx.HORIZONTAL)
+        hSizer.AddStretchSpacer(prop=1)
+        hSizer.Add(labeledTolerance, flag=wx.ALIGN_CENTER)
+        hSizer.Add(toleranceText, flag=wx.ALIGN_CENTER)
+        AddLinearSpacer(hSizer, 10)
+        hSizer.Add(sampledCheckBox, flag=wx.ALIGN_CENTER)
+        hSizer.AddStretchSpacer(prop=1)
+        self.sizer.Add(hSizer, flag=wx.ALIGN_CENTER)
 
         self.SetSizer(self.sizer)
         self.SetAutoLayout(1)
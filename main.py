@@ -6,6 +6,7 @@ import sys
 import traceback
 import shutil
 import json
+import threading
 from functools import partial
 from multiprocessing import freeze_support
 
@@ -15,6 +16,8 @@ from PIL import Image
 
 import images
 import shared
+import rename
+import scheduler
 import imggui
 from util import load_data, save_data, AddLinearSpacer, SetupChoice
 from widgets import LabeledWidget
@@ -42,6 +45,7 @@ class FilePanel(wx.Panel):
         convButton = wx.Button(parent=self, label='&Convert')
         convButton.Bind(wx.EVT_BUTTON, self.OnConvert)
         self.convert_callback = self.GetTopLevelParent().OnConversion
+        self.convert_thread = None
                 
         clearCheckBox = wx.CheckBox(parent=self,
                                     label='Clear Destination Folder')
@@ -54,6 +58,40 @@ class FilePanel(wx.Panel):
                          partial(self.OnCheckBox, attr='archive'))
         zipCheckBox.SetValue(shared.options.get('archive', False))
 
+        skipCheckBox = wx.CheckBox(parent=self, label='Skip Unchanged')
+        skipCheckBox.Bind(wx.EVT_CHECKBOX,
+                          partial(self.OnCheckBox, attr='incremental'))
+        skipCheckBox.SetValue(shared.options.get('incremental', False))
+        skipCheckBox.SetToolTipString('Only convert images that are new or '
+                                      'changed since the last conversion')
+
+        labeledWorkers = LabeledWidget(parent=self, cls=IntCtrl,
+                                       label='Worker Processes',
+                                       style=wx.TE_PROCESS_ENTER,
+                                       value=shared.options.get('workers', 0),
+                                       limited=True,
+                                       min=0)
+        workersCtrl = labeledWorkers.widget
+        workersCtrl.SetToolTipString('0 = one per processor core')
+        OnWorkers = partial(self.OnTextCtrl, attr='workers', ctrl=workersCtrl)
+        workersCtrl.Bind(wx.EVT_TEXT_ENTER, OnWorkers)
+        workersCtrl.Bind(wx.EVT_KILL_FOCUS, OnWorkers)
+
+        labeledMemory = LabeledWidget(parent=self, cls=IntCtrl,
+                                      label='Memory Limit (MB)',
+                                      style=wx.TE_PROCESS_ENTER,
+                                      value=shared.options.get('memory_limit',
+                                                               0),
+                                      limited=True,
+                                      min=0)
+        memoryCtrl = labeledMemory.widget
+        memoryCtrl.SetToolTipString('Memory shared by the conversions '
+                                    'running at once, 0 = half of the RAM')
+        OnMemory = partial(self.OnTextCtrl, attr='memory_limit',
+                           ctrl=memoryCtrl)
+        memoryCtrl.Bind(wx.EVT_TEXT_ENTER, OnMemory)
+        memoryCtrl.Bind(wx.EVT_KILL_FOCUS, OnMemory)
+
         # Sizer stuff
         self.sizer = wx.BoxSizer(wx.VERTICAL)
         self.sizer.AddStretchSpacer(prop=1)
@@ -85,8 +123,15 @@ class FilePanel(wx.Panel):
         hSizer.Add(clearCheckBox, flag=wx.CENTER)
         AddLinearSpacer(hSizer, 15)
         hSizer.Add(zipCheckBox, flag=wx.CENTER)
+        AddLinearSpacer(hSizer, 15)
+        hSizer.Add(skipCheckBox, flag=wx.CENTER)
         hSizer.AddStretchSpacer(prop=1)
         self.sizer.Add(hSizer, flag=wx.CENTER)
+
+        AddLinearSpacer(self.sizer, 15)
+        self.sizer.Add(labeledWorkers, flag=wx.CENTER)
+        AddLinearSpacer(self.sizer, 5)
+        self.sizer.Add(labeledMemory, flag=wx.CENTER)
         
         self.sizer.AddStretchSpacer(prop=1)
 
@@ -109,12 +154,52 @@ class FilePanel(wx.Panel):
         dlg.Destroy()
 
     def OnConvert(self, event):
-        images.convert_folder(callback=self.convert_callback, **shared.options)
+        if self.convert_thread and self.convert_thread.is_alive():
+            self.GetTopLevelParent().SetStatusText(
+                'Still converting, wait for it to finish')
+            return
+        try:
+            images.rename_template()
+        except rename.RenameError as e:
+            dlg = wx.MessageDialog(self, str(e), 'Rename Pattern',
+                                   wx.OK | wx.ICON_ERROR)
+            dlg.ShowModal()
+            dlg.Destroy()
+            return
+        # convert_folder blocks until the batch is done, so run it off the
+        # GUI thread and hand progress back to it with CallAfter
+        callback = partial(wx.CallAfter, self.convert_callback)
+        pool = self.GetTopLevelParent().worker_pool
+        self.convert_thread = threading.Thread(target=self.RunConversion,
+                                               kwargs=dict(shared.options,
+                                                           callback=callback,
+                                                           pool=pool))
+        self.convert_thread.daemon = True
+        self.convert_thread.start()
+
+    def RunConversion(self, **kwargs):
+        try:
+            images.convert_folder(**kwargs)
+        except Exception:
+            traceback.print_exc()
+            wx.CallAfter(self.OnConvertError, traceback.format_exc())
+
+    def OnConvertError(self, message):
+        self.GetTopLevelParent().SetStatusText('Conversion failed')
+        dlg = wx.MessageDialog(self, message, 'Conversion Failed',
+                               wx.OK | wx.ICON_ERROR)
+        dlg.ShowModal()
+        dlg.Destroy()
 
     def OnCheckBox(self, event, attr):
         shared.options[attr] = event.IsChecked()
         save_data(shared.options)
 
+    def OnTextCtrl(self, event, attr, ctrl):
+        shared.options[attr] = ctrl.GetValue()
+        save_data(shared.options)
+        event.Skip()
+
 
 class FormatPanel(wx.Panel):
     def __init__(self, parent):
@@ -354,6 +439,8 @@ class MainWindow(wx.Frame, FocusMixIn):
     def __init__(self, *args, **kwargs):
         wx.Frame.__init__(self, *args, **kwargs)
         shared.options.update(load_data())
+        # Started by the first conversion and kept until the window closes
+        self.worker_pool = scheduler.WorkerPool(images.init_worker)
 
         #menu setup
         self.CreateStatusBar() # A Statusbar in the bottom of the window
@@ -371,6 +458,7 @@ class MainWindow(wx.Frame, FocusMixIn):
         # Events.
         self.Bind(wx.EVT_MENU, self.OnExit, menuExit)
         self.Bind(wx.EVT_MENU, self.OnAbout, menuAbout)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
 
         # Here we create a panel and a notebook on the panel
         panel = wx.Panel(self)
@@ -405,6 +493,11 @@ class MainWindow(wx.Frame, FocusMixIn):
     def OnExit(self, event):
         self.Close(True)  # Close the frame.
 
+    def OnClose(self, event):
+        # Anything still converting is abandoned
+        self.worker_pool.terminate()
+        event.Skip()
+
     def OnConversion(self, imagename, exception):
         if exception:
             self.SetStatusText('Failed to process ' + imagename)
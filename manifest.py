@@ -0,0 +1,110 @@
+import os
+import json
+import hashlib
+from functools import partial
+
+# Kept in the destination folder next to the converted images
+manifest_name = '.superconverter.json'
+version = 2
+
+
+def settings_hash(*settings):
+    data = json.dumps(settings, sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(partial(infile.read, block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_state(path):
+    """Return the size, mtime and content hash of path, as a Manifest
+    records them.  Done by the worker converting the file, so the files
+    are hashed in parallel and the hash is of what was converted."""
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime,
+            'hash': file_hash(path)}
+
+
+class Manifest(object):
+    """Record of what convert_folder wrote to a destination folder.
+
+    Entries are keyed on the absolute source path, so folders converted
+    into the same destination don't share entries, and hold the source's
+    size, mtime and content hash (see source_state), a hash of the
+    settings it was converted with and the name of the output.  A source
+    is up to date when all of these still match and the output is still
+    there.
+    """
+
+    def __init__(self, dest_dir, fresh=False):
+        self.path = os.path.join(dest_dir, manifest_name)
+        self.dest_dir = dest_dir
+        self.entries = {}
+        if not fresh:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rt') as infile:
+                data = json.load(infile)
+        except (IOError, ValueError):
+            return
+        if isinstance(data, dict) and data.get('version') == version:
+            self.entries = data.get('entries', {})
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wt') as outfile:
+                json.dump({'version': version, 'entries': self.entries},
+                          outfile)
+            if os.path.exists(self.path):
+                # os.rename won't replace a file on Windows
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def is_current(self, src_path, settings):
+        """Return whether src_path needs no conversion.  The source is
+        only hashed when its size matches but its mtime does not."""
+        entry = self.entries.get(os.path.abspath(src_path))
+        if entry is None or entry.get('settings') != settings:
+            return False
+        try:
+            st = os.stat(src_path)
+        except OSError:
+            return False
+        if st.st_size != entry.get('size'):
+            return False
+        output = entry.get('output')
+        if not output or not os.path.isfile(os.path.join(self.dest_dir,
+                                                         output)):
+            return False
+        if st.st_mtime != entry.get('mtime'):
+            try:
+                if file_hash(src_path) != entry.get('hash'):
+                    return False
+            except IOError:
+                return False
+            # Touched but unchanged
+            entry['mtime'] = st.st_mtime
+        return True
+
+    def update(self, src_path, state, settings, output):
+        """Record that src_path, as given by state from source_state, was
+        converted to output with settings."""
+        if state is None:
+            self.discard(src_path)
+            return
+        self.entries[os.path.abspath(src_path)] = dict(state,
+                                                       settings=settings,
+                                                       output=output)
+
+    def discard(self, src_path):
+        self.entries.pop(os.path.abspath(src_path), None)
@@ -169,6 +169,7 @@ try: # See :pyver:old
     import itertools
 except:
     pass
+import binascii
 import math
 # http://www.python.org/doc/2.4.4/lib/module-operator.html
 import operator
@@ -183,6 +184,10 @@ try:
     import cpngfilters as pngfilters
 except ImportError:
     pass
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __all__ = ['Image', 'Reader', 'Writer', 'write_chunks', 'from_array']
@@ -237,6 +242,136 @@ except:
     strtobytes = str
     bytestostr = str
 
+# Zero copy views of objects supporting the buffer interface (str,
+# bytearray, mmap, numpy arrays, and so on).  `size` -1 means to the
+# end.
+try:
+    buffer
+    def bufferview(obj, offset=0, size=-1):
+        return buffer(obj, offset, size)
+except NameError:
+    def bufferview(obj, offset=0, size=-1):
+        view = memoryview(obj)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast('B')
+        if size < 0:
+            return view[offset:]
+        return view[offset:offset+size]
+
+def writableview(obj):
+    """Return something that the bytes of `obj` can be assigned to by
+    slice.  mmap objects on Python 2 don't support ``memoryview`` but
+    can be sliced themselves.
+    """
+
+    try:
+        view = memoryview(obj)
+    except TypeError:
+        return obj
+    if view.readonly:
+        raise TypeError("buffer is not writable")
+    if view.ndim != 1 or view.itemsize != 1:
+        try:
+            view = view.cast('B')
+        except AttributeError:
+            raise ValueError(
+              "buffer should be one dimensional with 1 byte items, "
+              "try reshaping it")
+    return view
+
+# Translation tables for :func:`pack_samples` and
+# :func:`unpack_samples`.  Sample values 0 to 15 become the digits
+# '0' to 'f'; anything bigger becomes 'z', which is not a digit in any
+# base used.
+_digits = strtobytes('0123456789abcdef' + 'z'*240)
+# Maps each hexadecimal digit to the sample values for each position
+# within it, keyed by bitdepth.
+_hex_samples = {}
+for _bitdepth in (1, 2, 4):
+    _tables = []
+    for _k in range(4 // _bitdepth):
+        _shift = 4 - _bitdepth * (_k + 1)
+        _table = [0]*256
+        for _value, _digit in enumerate('0123456789abcdef'):
+            _table[ord(_digit)] = (_value >> _shift) & (2**_bitdepth - 1)
+        _tables.append(strtobytes(''.join(map(chr, _table))))
+    _hex_samples[_bitdepth] = _tables
+del _bitdepth, _tables, _k, _shift, _table, _value, _digit
+
+def pack_samples(samples, bitdepth):
+    """Pack a row of samples, each of `bitdepth` bits (1, 2, or 4), into
+    bytes, most significant bits first, padding the last byte with
+    zeroes.  Returns an ``array('B')``.
+
+    The samples are turned into a string of base 2**`bitdepth` digits,
+    read as one integer and written back out in hexadecimal, so the
+    work is all done by C code in time linear in the length of the row
+    (the bases are powers of two).
+    """
+
+    spb = 8 // bitdepth
+    if not (isarray(samples) and samples.typecode == 'B'):
+        samples = array('B', samples)
+    if not samples:
+        return array('B')
+    # Padding digits.
+    extra = -len(samples) % spb
+    digits = tostring(samples).translate(_digits) + strtobytes('0'*extra)
+    if bitdepth != 4:
+        digits = '%0*x' % (len(digits) * bitdepth // 4,
+                           int(digits, 2**bitdepth))
+    elif 'z' in bytestostr(digits):
+        raise ValueError("sample value too big for bit depth %d" % bitdepth)
+    return array('B', binascii.unhexlify(digits))
+
+def unpack_samples(raw, bitdepth, width=None):
+    """Unpack a row of bytes into samples of `bitdepth` bits (1, 2, or
+    4); the inverse of :func:`pack_samples`.  If `width` is given, the
+    result is cut to that many samples.  Returns an ``array('B')``.
+    """
+
+    if isarray(raw):
+        raw = tostring(raw)
+    digits = binascii.hexlify(raw)
+    tables = _hex_samples[bitdepth]
+    if len(tables) == 1:
+        out = array('B', digits.translate(tables[0]))
+    else:
+        out = array('B', [0]) * (len(digits) * len(tables))
+        for k, table in enumerate(tables):
+            out[k::len(tables)] = array('B', digits.translate(table))
+    if width is not None:
+        del out[width:]
+    return out
+
+def pack_16(samples):
+    """Pack a row of 16-bit samples into big-endian bytes, as a
+    string.  Uses ``array.byteswap`` (or a numpy ``>u2`` view) rather
+    than building a tuple for ``struct``.
+    """
+
+    if numpy is not None and isinstance(samples, numpy.ndarray):
+        return numpy.asarray(samples, '>u2').tostring()
+    # A copy, which is swapped in place
+    samples = array('H', samples)
+    if sys.byteorder == 'little':
+        samples.byteswap()
+    return tostring(samples)
+
+def unpack_16(raw):
+    """Unpack a row of big-endian bytes (a string or ``array('B')``)
+    into 16-bit samples; the inverse of :func:`pack_16`.  Returns an
+    ``array('H')``.
+    """
+
+    out = array('H')
+    if isarray(raw):
+        raw = tostring(raw)
+    getattr(out, 'frombytes', out.fromstring)(raw)
+    if sys.byteorder == 'little':
+        out.byteswap()
+    return out
+
 def interleave_planes(ipixels, apixels, ipsize, apsize):
     """
     Interleave (colour) planes, e.g. RGB + A = RGBA.
@@ -310,6 +445,10 @@ class ChunkError(FormatError):
     prefix = 'ChunkError'
 
 
+# zlib's run length encoding strategy, which the zlib module only
+# names from Python 3.6.
+Z_RLE = getattr(zlib, 'Z_RLE', 3)
+
 class Writer:
     """
     PNG encoder in pure Python.
@@ -330,7 +469,11 @@ class Writer:
                  planes=None,
                  colormap=None,
                  maxval=None,
-                 chunk_limit=2**20):
+                 chunk_limit=2**20,
+                 filter_type=0,
+                 threads=1,
+                 strategy=None,
+                 sbit=None):
         """
         Create a PNG encoder object.
 
@@ -360,6 +503,8 @@ class Writer:
           Create an interlaced image.
         chunk_limit
           Write multiple ``IDAT`` chunks to save memory.
+        filter_type
+          Scanline filter: 0 to 4, ``'sum'`` or ``'brute'``; default: 0.
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -442,11 +587,44 @@ class Writer:
         .. note ::
         
           Enabling the `interlace` option requires the entire image
-          to be processed in working memory.
+          to be processed in working memory, unless the rows are
+          supplied as an indexable sequence (see :meth:`write`).
 
         `chunk_limit` is used to limit the amount of memory used whilst
         compressing the image.  In order to avoid using large amounts of
         memory, multiple ``IDAT`` chunks may be created.
+
+        `filter_type` selects the filter applied to each scanline before
+        compression.  An integer from 0 to 4 uses that filter type
+        ("none", "sub", "up", "average", "paeth") for every scanline.
+        ``'sum'`` picks, for each scanline, the filter whose output has
+        the smallest sum of absolute values (treating the bytes as
+        signed); this is the heuristic recommended by the PNG
+        specification and usually the best choice for colour and 8-bit
+        greyscale images.  ``'brute'`` compresses each candidate and
+        keeps the smallest, which is a lot slower and only slightly
+        better.  Palette images and bit depths below 8 generally
+        compress best with filter type 0.
+
+        `threads` is the number of threads used to compress the image
+        data, 0 meaning one per processor.  With more than one thread
+        the data is compressed in independent blocks (see
+        :class:`ParallelCompressor`), which makes the file very slightly
+        larger; this is only done for images with more than a few
+        blocks of data.
+
+        `strategy` is passed to zlib to tune the compression algorithm:
+        ``zlib.Z_DEFAULT_STRATEGY`` (the default), ``zlib.Z_FILTERED``,
+        ``zlib.Z_HUFFMAN_ONLY``, or :const:`Z_RLE`.  Which one does best
+        depends on the image and the filter type, so they are mostly of
+        use when trying several combinations and keeping the smallest.
+
+        `sbit` records, in an ``sBIT`` chunk, that only that many bits
+        of each sample are significant, without changing the samples.
+        It is for callers that have already scaled their samples up to
+        `bitdepth` themselves, which is otherwise what the writer does
+        for bit depths PNG does not support.  It cannot be used with a
+        palette or such a bit depth.
         """
 
         # At the moment the `planes` argument is ignored;
@@ -572,6 +750,21 @@ class Writer:
         if bitdepth > 8 and palette:
             raise ValueError(
                 "bit depth must be 8 or less for images with palette")
+        if sbit is not None:
+            if self.rescale or palette:
+                raise ValueError(
+                  "sbit cannot be used with a palette or bit depth %d" %
+                  (self.rescale[0] if self.rescale else bitdepth))
+            if int(sbit) != sbit or not 1 <= sbit <= bitdepth:
+                raise ValueError("sbit (%r) must be 1 to the bit depth" %
+                                 sbit)
+        if filter_type not in (0, 1, 2, 3, 4, 'sum', 'brute'):
+            raise ValueError(
+                "filter_type (%r) must be 0 to 4, 'sum' or 'brute'" %
+                filter_type)
+        if threads is None or int(threads) != threads or threads < 0:
+            raise ValueError("threads (%r) must be a non-negative integer" %
+                             threads)
 
         transparent = check_color(transparent, 'transparent')
         background = check_color(background, 'background')
@@ -592,6 +785,10 @@ class Writer:
         self.chunk_limit = chunk_limit
         self.interlace = bool(interlace)
         self.palette = check_palette(palette)
+        self.filter_type = filter_type
+        self.threads = threads
+        self.strategy = strategy
+        self.sbit = sbit
 
         self.color_type = 4*self.alpha + 2*(not greyscale) + 1*self.colormap
         assert self.color_type in (0,2,3,4,6)
@@ -620,6 +817,66 @@ class Writer:
             return p,t
         return p,None
 
+    def pass_starts(self):
+        """Return the set of scanline indexes (counting the scanlines in
+        the order they are written) that begin a reduced image.  For a
+        straightlaced image this is just the first scanline; for an
+        interlaced image it is the first scanline of each non-empty
+        Adam7 pass.
+        """
+
+        if not self.interlace:
+            return set([0])
+        starts = set()
+        i = 0
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width:
+                continue
+            starts.add(i)
+            i += len(range(ystart, self.height, ystep))
+        return starts
+
+    def filter_line(self, line, prev):
+        """Filter the packed scanline `line` according to the writer's
+        `filter_type`, returning a fresh array that starts with the
+        filter type byte.  `prev` is the previous packed scanline of the
+        same reduced image, or ``None`` for the first scanline of a
+        pass.
+        """
+
+        # Filter offset, see :meth:`filter_scanline`.
+        fo = max(1, self.psize)
+        if not prev:
+            # An all-zero line is what the decoder assumes above the
+            # first scanline of a pass, and it keeps every filter type
+            # on the general code path of filter_scanline.
+            prev = array('B', [0]*len(line))
+        if self.filter_type in (0, 1, 2, 3, 4):
+            return filter_scanline(self.filter_type, line, fo, prev)
+        candidates = [filter_scanline(type, line, fo, prev)
+                      for type in range(5)]
+        if self.filter_type == 'sum':
+            cost = sum_cost
+        else:
+            assert self.filter_type == 'brute'
+            level = self.compression
+            if level is None:
+                level = -1
+            def cost(filtered):
+                return len(zlib.compress(tostring(filtered), level))
+        return min(candidates, key=cost)
+
+    def parallel_compression(self):
+        """Return whether the image data is worth compressing on more
+        than one thread."""
+
+        if self.threads == 1 or self.compression == 0:
+            return False
+        row_bytes = 1 + int(math.ceil(self.width * self.planes *
+                                      self.bitdepth / 8.0))
+        # Below a few blocks the thread pool costs more than it saves.
+        return row_bytes * self.height >= 4 * ParallelCompressor.block_size
+
     def write(self, outfile, rows):
         """Write a PNG image to the output file.  `rows` should be
         an iterable that yields each row in boxed row flat pixel format.
@@ -631,10 +888,21 @@ class Writer:
         
         .. note ::
 
-          Interlacing will require the entire image to be in working memory.
+          Interlacing will require the entire image to be in working
+          memory, unless `rows` is a sequence that can be indexed by row
+          number (a list, a numpy array, or any object with
+          ``__getitem__`` and ``__len__``).  Each pass is then read
+          straight from `rows`, one row at a time.
         """
 
         if self.interlace:
+            if hasattr(rows, '__getitem__') and hasattr(rows, '__len__'):
+                if len(rows) != self.height:
+                    raise ValueError(
+                      "rows supplied (%d) does not match height (%d)" %
+                      (len(rows), self.height))
+                return self.write_passes(outfile,
+                                         self.rows_scanlines_interlace(rows))
             fmt = 'BH'[self.bitdepth > 8]
             a = array(fmt, itertools.chain(*rows))
             return self.write_array(outfile, a)
@@ -661,10 +929,24 @@ class Writer:
         `rows` should be an iterable that yields each row.  When
         `packed` is ``False`` the rows should be in boxed row flat pixel
         format; when `packed` is ``True`` each row should be a packed
-        sequence of bytes.
+        sequence of bytes, or a string or buffer holding them.
 
         """
 
+        count = [0]
+        def counted():
+            for row in rows:
+                count[0] += 1
+                yield row
+        self.write_filtered(outfile, self.iter_filtered(counted(), packed))
+        return count[0]
+
+    def write_filtered(self, outfile, blocks):
+        """
+        Write a PNG image to the output file, with `blocks` the strings
+        of filtered data that :meth:`iter_filtered` yields.
+        """
+
         # http://www.w3.org/TR/PNG/#5PNG-file-signature
         outfile.write(_signature)
 
@@ -682,10 +964,10 @@ class Writer:
 
         # See :chunk:order
         # http://www.w3.org/TR/PNG/#11sBIT
-        if self.rescale:
+        if self.rescale or self.sbit:
             write_chunk(outfile, 'sBIT',
                 struct.pack('%dB' % self.planes,
-                            *[self.rescale[0]]*self.planes))
+                            *[self.sbit or self.rescale[0]]*self.planes))
         
         # :chunk:order: Without a palette (PLTE chunk), ordering is
         # relatively relaxed.  With one, gAMA chunk must precede PLTE
@@ -718,45 +1000,98 @@ class Writer:
                             struct.pack("!3H", *self.background))
 
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
-            compressor = zlib.compressobj(self.compression)
+        # Always closed, so that the threads of a ParallelCompressor are
+        # stopped even when the rows raise part way through.
+        level = self.compression
+        if level is None:
+            level = -1
+        if self.parallel_compression():
+            compressor = ParallelCompressor(level, self.threads or None,
+                                            self.strategy)
+        elif self.strategy is not None:
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          zlib.MAX_WBITS, 8, self.strategy)
         else:
-            compressor = zlib.compressobj()
+            compressor = zlib.compressobj(level)
+
+        try:
+            compressed = ''
+            for block in blocks:
+                if len(compressed):
+                    # print >> sys.stderr, len(block), len(compressed)
+                    write_chunk(outfile, 'IDAT', compressed)
+                compressed = compressor.compress(block)
+            flushed = compressor.flush()
+            if len(compressed) or len(flushed):
+                # print >> sys.stderr, len(compressed), len(flushed)
+                write_chunk(outfile, 'IDAT', compressed + flushed)
+        finally:
+            close = getattr(compressor, 'close', None)
+            if close is not None:
+                close()
+        # http://www.w3.org/TR/PNG/#11IEND
+        write_chunk(outfile, 'IEND')
+
+    def iter_filtered(self, rows, packed=False):
+        """
+        Pack and filter `rows`, given as to :meth:`write_passes`, and
+        yield the data that goes into the IDAT chunks, before it is
+        compressed, as strings of about `chunk_limit` bytes.  Together
+        with :meth:`write_filtered` this lets the same filtered data be
+        compressed in several ways without being filtered again.
+        """
 
         # Choose an extend function based on the bitdepth.  The extend
         # function packs/decomposes the pixel values into bytes and
         # stuffs them onto the data array.
         data = array('B')
-        if self.bitdepth == 8 or packed:
+        if packed:
+            fromstring = getattr(data, 'frombytes', data.fromstring)
+            def extend(sl):
+                if isinstance(sl, (array, list)):
+                    data.extend(sl)
+                else:
+                    # str, or a view from :func:`bufferview`
+                    fromstring(sl)
+        elif self.bitdepth == 8:
             extend = data.extend
         elif self.bitdepth == 16:
             # Decompose into bytes
+            fromstring = getattr(data, 'frombytes', data.fromstring)
             def extend(sl):
-                fmt = '!%dH' % len(sl)
-                data.extend(array('B', struct.pack(fmt, *sl)))
+                fromstring(pack_16(sl))
         else:
             # Pack into bytes
             assert self.bitdepth < 8
-            # samples per byte
-            spb = int(8/self.bitdepth)
             def extend(sl):
-                a = array('B', sl)
-                # Adding padding bytes so we can group into a whole
-                # number of spb-tuples.
-                l = float(len(a))
-                extra = math.ceil(l / float(spb))*spb - l
-                a.extend([0]*int(extra))
-                # Pack into bytes
-                l = group(a, spb)
-                l = map(lambda e: reduce(lambda x,y:
-                                           (x << self.bitdepth) + y, e), l)
-                data.extend(l)
+                data.extend(pack_samples(sl, self.bitdepth))
         if self.rescale:
             oldextend = extend
             factor = \
               float(2**self.rescale[1]-1) / float(2**self.rescale[0]-1)
+            # The scaled value of every possible sample.
+            table = [int(round(factor*x)) for x in range(2**self.rescale[0])]
             def extend(sl):
-                oldextend(map(lambda x: int(round(factor*x)), sl))
+                oldextend(map(table.__getitem__, sl))
+
+        if self.filter_type != 0:
+            # Filter each scanline after it has been packed onto the
+            # end of ``data``.  The previous scanline is forgotten at
+            # the start of each reduced (interlace pass) image, because
+            # that is what the decoder does.
+            unfiltered_extend = extend
+            pass_starts = self.pass_starts()
+            state = dict(i=0, prev=None)
+            def extend(sl):
+                start = len(data)
+                unfiltered_extend(sl)
+                line = data[start:]
+                if state['i'] in pass_starts:
+                    state['prev'] = None
+                state['i'] += 1
+                # Replace the filter type byte as well as the line.
+                data[start-1:] = self.filter_line(line, state['prev'])
+                state['prev'] = line
 
         # Build the first row, testing mostly to see if we need to
         # changed the extend function to cope with NumPy integer types
@@ -766,12 +1101,13 @@ class Writer:
         enumrows = enumerate(rows)
         del rows
 
-        # First row's filter type.
+        # First row's filter type (a placeholder when filtering).
         data.append(0)
         # :todo: Certain exceptions in the call to ``.next()`` or the
         # following try would indicate no row data supplied.
         # Should catch.
-        i,row = enumrows.next()
+        i,row = next(enumrows)
+        start = len(data)
         try:
             # If this fails...
             extend(row)
@@ -780,6 +1116,7 @@ class Writer:
             # Not only does this work for the (slightly broken) NumPy
             # types, there are probably lots of other, unknown, "nearly"
             # int types it works for.
+            del data[start:]
             def wrapmapint(f):
                 return lambda sl: f(map(int, sl))
             extend = wrapmapint(extend)
@@ -787,34 +1124,19 @@ class Writer:
             extend(row)
 
         for i,row in enumrows:
-            # Add "None" filter type.  Currently, it's essential that
-            # this filter type be used for every scanline as we do not
-            # mark the first row of a reduced pass image; that means we
-            # could accidentally compute the wrong filtered scanline if
-            # we used "up", "average", or "paeth" on such a line.
+            # Add "None" filter type; when filtering, ``extend`` replaces
+            # it with the type actually used.
             data.append(0)
             extend(row)
             if len(data) > self.chunk_limit:
-                compressed = compressor.compress(tostring(data))
-                if len(compressed):
-                    # print >> sys.stderr, len(data), len(compressed)
-                    write_chunk(outfile, 'IDAT', compressed)
+                yield tostring(data)
                 # Because of our very witty definition of ``extend``,
                 # above, we must re-use the same ``data`` object.  Hence
                 # we use ``del`` to empty this one, rather than create a
                 # fresh one (which would be my natural FP instinct).
                 del data[:]
         if len(data):
-            compressed = compressor.compress(tostring(data))
-        else:
-            compressed = ''
-        flushed = compressor.flush()
-        if len(compressed) or len(flushed):
-            # print >> sys.stderr, len(data), len(compressed), len(flushed)
-            write_chunk(outfile, 'IDAT', compressed + flushed)
-        # http://www.w3.org/TR/PNG/#11IEND
-        write_chunk(outfile, 'IEND')
-        return i+1
+            yield tostring(data)
 
     def write_array(self, outfile, pixels):
         """
@@ -847,13 +1169,77 @@ class Writer:
               self.rescale[0])
         return self.write_passes(outfile, rows, packed=True)
 
+    def write_buffer(self, outfile, buffer, stride=None, offset=0):
+        """
+        Write a PNG image from raw pixel data held in `buffer`, which
+        can be any object supporting the buffer interface: a string,
+        ``bytearray``, ``mmap``, numpy array, and so on.  Rows are read
+        from the buffer without being copied when they need no
+        conversion.
+
+        The data is laid out as in a binary Netpbm file (and as
+        written by :meth:`Reader.read_into`): each sample is 1 byte
+        for bit depths up to 8 and 2 bytes, big-endian, above that.
+        Row *y* starts at byte `offset` + *y* * `stride`; `stride`
+        defaults to the length of a row, and ``self.height`` rows are
+        read.
+        """
+
+        planes = self.planes
+        if self.rescale:
+            bitdepth = self.rescale[0]
+        else:
+            bitdepth = self.bitdepth
+        sample_bytes = 1 + (bitdepth > 8)
+        row_bytes = self.width * planes * sample_bytes
+        if stride is None:
+            stride = row_bytes
+        if stride < row_bytes:
+            raise ValueError("stride (%d) is less than the row length (%d)" %
+                             (stride, row_bytes))
+        needed = offset + (self.height - 1) * stride + row_bytes
+        if len(bufferview(buffer)) < needed:
+            raise ValueError("buffer is too small, %d bytes are needed" %
+                             needed)
+
+        if bitdepth in (8, 16) and not self.rescale:
+            # The bytes are the same as PNG's, pass them straight on
+            if not self.interlace:
+                rows = BufferRows(buffer, row_bytes, self.height,
+                                  stride, offset)
+            else:
+                rows = self.rows_scanlines_interlace(
+                  BufferRows(buffer, row_bytes, self.height, stride, offset,
+                             typecode='B'),
+                  planes=planes * sample_bytes)
+            return self.write_passes(outfile, rows, packed=True)
+        rows = BufferRows(buffer, row_bytes, self.height, stride, offset,
+                          typecode='BH'[sample_bytes > 1])
+        return self.write(outfile, rows)
+
     def convert_pnm(self, infile, outfile):
         """
         Convert a PNM file containing raw pixel data into a PNG file
         with the parameters set in the writer object.  Works for
         (binary) PGM, PPM, and PAM formats.
+
+        When `infile` is a regular file it is memory mapped and
+        written with :meth:`write_buffer`.
         """
 
+        try:
+            import mmap
+            pixels = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ImportError, EnvironmentError, ValueError):
+            # Not a real file (or an empty one), read it the old way
+            pixels = None
+        if pixels is not None:
+            try:
+                return self.write_buffer(outfile, pixels,
+                                         offset=infile.tell())
+            finally:
+                pixels.close()
+
         if self.interlace:
             pixels = array('B')
             pixels.fromfile(infile,
@@ -900,9 +1286,8 @@ class Writer:
         if self.bitdepth > 8:
             assert self.bitdepth == 16
             row_bytes *= 2
-            fmt = '>%dH' % vpr
             def line():
-                return array('H', struct.unpack(fmt, infile.read(row_bytes)))
+                return unpack_16(infile.read(row_bytes))
         else:
             def line():
                 scanline = array('B', infile.read(row_bytes))
@@ -960,6 +1345,84 @@ class Writer:
                             pixels[offset+i:end_offset:skip]
                     yield row
 
+    def rows_scanlines_interlace(self, rows, planes=None):
+        """
+        Generator for interlaced scanlines from a sequence of rows.
+        `rows` is indexed by row number and each row is in boxed row
+        flat pixel format, as for :meth:`write`.  The passes are read
+        from `rows` one row at a time, so only the source and a single
+        reduced row need be in memory.
+
+        `planes` is the number of values per pixel, ``self.planes`` by
+        default.  Rows of 16-bit samples held as bytes can be
+        interlaced by giving twice that.
+        """
+
+        fmt = 'BH'[self.bitdepth > 8]
+        if planes is None:
+            planes = self.planes
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width:
+                continue
+            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
+            row_len = ppr*planes
+            offset = xstart * planes
+            skip = planes * xstep
+            for y in range(ystart, self.height, ystep):
+                row = rows[y]
+                if not isarray(row):
+                    row = array(fmt, row)
+                if xstep == 1:
+                    yield row
+                    continue
+                # A copy of the right type and length to fill in
+                reduced = row[0:row_len]
+                for i in range(planes):
+                    reduced[i::planes] = row[offset+i::skip]
+                yield reduced
+
+class BufferRows(object):
+    """
+    The rows of an image held in an object supporting the buffer
+    interface, as a sequence.  Each row is `row_bytes` long and row
+    *y* starts at `offset` + *y* * `stride`.
+
+    Without a `typecode` each row is a zero copy view of the buffer.
+    With one, each row is copied into an ``array`` of that type; 16-bit
+    (``'H'``) samples are taken to be big-endian in the buffer.
+    """
+
+    def __init__(self, buffer, row_bytes, height, stride=None, offset=0,
+                 typecode=None):
+        self.buffer = buffer
+        self.row_bytes = row_bytes
+        self.height = height
+        self.stride = stride or row_bytes
+        self.offset = offset
+        self.typecode = typecode
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, y):
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError('row index out of range')
+        view = bufferview(self.buffer, self.offset + y*self.stride,
+                          self.row_bytes)
+        if self.typecode is None:
+            return view
+        if self.typecode == 'H':
+            return unpack_16(view)
+        row = array(self.typecode)
+        getattr(row, 'frombytes', row.fromstring)(view)
+        return row
+
+    def __iter__(self):
+        for y in range(self.height):
+            yield self[y]
+
 def write_chunk(outfile, tag, data=strtobytes('')):
     """
     Write a PNG chunk to the output file, including length and
@@ -983,6 +1446,138 @@ def write_chunks(out, chunks):
     for chunk in chunks:
         write_chunk(out, *chunk)
 
+class ParallelCompressor:
+    """
+    Drop in replacement for a ``zlib.compressobj``, as used by
+    :meth:`Writer.write_passes`, that compresses blocks of the data on
+    a pool of threads (:mod:`zlib` releases the GIL while it works).
+
+    Each block is deflated on its own, ending with a sync flush so that
+    it finishes on a byte boundary, and the blocks are concatenated in
+    order behind a single zlib header.  To lose as little as possible
+    to the split, each block's compressor is first fed the last 32K of
+    the data before it, whose output is thrown away; the block can
+    then refer back into data the decoder already has.  The Adler-32
+    checksum is computed on the uncompressed data as it arrives.  This
+    is the scheme used by ``pigz``.
+    """
+
+    # The deflate window.
+    window = 2**15
+    # Uncompressed bytes per block.
+    block_size = 2**18
+
+    def __init__(self, level=None, threads=None, strategy=None):
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+        if level is None:
+            level = -1
+        self.level = level
+        if strategy is None:
+            strategy = zlib.Z_DEFAULT_STRATEGY
+        self.strategy = strategy
+        threads = threads or cpu_count()
+        self.pool = ThreadPool(threads)
+        # Blocks submitted but not yet returned, in order.
+        self.pending = []
+        self.max_pending = 2 * threads
+        self.buffer = strtobytes('')
+        self.tail = strtobytes('')
+        self.adler = 1
+
+        # http://www.ietf.org/rfc/rfc1950.txt
+        if level in (0, 1):
+            flevel = 0
+        elif level in (-1, 6):
+            flevel = 2
+        elif level < 6:
+            flevel = 1
+        else:
+            flevel = 3
+        cmf = 0x78
+        flg = flevel << 6
+        flg += 31 - (cmf*256 + flg) % 31
+        self.header = struct.pack('2B', cmf, flg)
+
+    def _deflate(self, tail, block, final):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS, 8, self.strategy)
+        if tail:
+            compressor.compress(tail)
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        data = compressor.compress(block)
+        if final:
+            return data + compressor.flush(zlib.Z_FINISH)
+        return data + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def _submit(self, block, final):
+        self.adler = zlib.adler32(block, self.adler)
+        self.pending.append(self.pool.apply_async(self._deflate,
+                                                  (self.tail, block, final)))
+        self.tail = block[-self.window:]
+
+    def _collect(self, wait):
+        """Return the output of the finished blocks at the front of the
+        queue, waiting for all but `wait` of them."""
+
+        out = []
+        if self.header:
+            out.append(self.header)
+            self.header = None
+        while self.pending and (len(self.pending) > wait or
+                                self.pending[0].ready()):
+            out.append(self.pending.pop(0).get())
+        return strtobytes('').join(out)
+
+    def compress(self, data):
+        self.buffer += data
+        if len(self.buffer) < self.block_size:
+            return strtobytes('')
+        buffer = self.buffer
+        self.buffer = strtobytes('')
+        for i in range(0, len(buffer) - self.block_size + 1,
+                       self.block_size):
+            self._submit(buffer[i:i+self.block_size], False)
+        self.buffer = buffer[i+self.block_size:]
+        return self._collect(self.max_pending)
+
+    def flush(self):
+        self._submit(self.buffer, True)
+        self.buffer = strtobytes('')
+        out = self._collect(0)
+        self.close()
+        return out + struct.pack('!I', self.adler & (2**32-1))
+
+    def close(self):
+        """Stop the threads, dropping any blocks not yet collected.
+        :meth:`flush` calls it, and it must be called to give up on
+        compressing part way through; calling it again does nothing."""
+
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.pending = []
+
+# Absolute value of each byte taken as a signed (two's complement)
+# number.  Used by the 'sum' filter heuristic.
+_signed_abs = [min(x, 256-x) for x in range(256)]
+# The same as a table for ``translate``.
+_signed_abs_table = strtobytes(''.join(map(chr, _signed_abs)))
+
+def sum_cost(filtered):
+    """Return the cost of a filtered scanline, given with its filter
+    type byte first, for the 'sum' filter heuristic: the sum of the
+    absolute values of its bytes taken as signed."""
+
+    if numpy is not None:
+        f = numpyfilters.asbytes(filtered)[1:]
+        # Negating a byte is the same modulo 256.
+        return int(numpy.minimum(f, -f).sum(dtype=numpy.int64))
+    # translate and summing a bytearray run in C, not per byte in Python.
+    costs = tostring(filtered)[1:].translate(_signed_abs_table)
+    return sum(bytearray(costs))
+
 def filter_scanline(type, line, fo, prev=None):
     """Apply a scanline filter to a scanline.  `type` specifies the
     filter type (0 to 4); `line` specifies the current (unfiltered)
@@ -1056,6 +1651,8 @@ def filter_scanline(type, line, fo, prev=None):
             type = 1
     if type == 0:
         out.extend(line)
+    elif numpy is not None:
+        out.fromstring(numpyfilters.filter_scanline(type, line, fo, prev))
     elif type == 1:
         sub()
     elif type == 2:
@@ -1325,6 +1922,9 @@ class Reader:
     PNG decoder in pure Python.
     """
 
+    # Most bytes produced by each call to the decompressor.
+    decompress_size = 2**16
+
     def __init__(self, _guess=None, **kw):
         """
         Create a PNG decoder object.
@@ -1563,7 +2163,7 @@ class Reader:
         # writes to the output array randomly (well, not quite), so the
         # entire output array must be in memory.
         fmt = 'BH'[self.bitdepth > 8]
-        a = array(fmt, [0]*vpr*self.height)
+        a = array(fmt, [0]) * (vpr*self.height)
         source_offset = 0
 
         for xstart, ystart, xstep, ystep in _adam7:
@@ -1613,18 +2213,9 @@ class Reader:
             if self.bitdepth == 8:
                 return raw
             if self.bitdepth == 16:
-                raw = tostring(raw)
-                return array('H', struct.unpack('!%dH' % (len(raw)//2), raw))
+                return unpack_16(raw)
             assert self.bitdepth < 8
-            width = self.width
-            # Samples per byte
-            spb = 8//self.bitdepth
-            out = array('B')
-            mask = 2**self.bitdepth - 1
-            shifts = map(self.bitdepth.__mul__, reversed(range(spb)))
-            for o in raw:
-                out.extend(map(lambda i: mask&(o>>i), shifts))
-            return out[:width]
+            return unpack_samples(raw, self.bitdepth, self.width)
 
         return itertools.imap(asvalues, rows)
 
@@ -1636,23 +2227,18 @@ class Reader:
         if self.bitdepth == 8:
             return bytes
         if self.bitdepth == 16:
-            bytes = tostring(bytes)
-            return array('H',
-              struct.unpack('!%dH' % (len(bytes)//2), bytes))
+            return unpack_16(bytes)
         assert self.bitdepth < 8
         if width is None:
             width = self.width
-        # Samples per byte
-        spb = 8//self.bitdepth
+        # Each row starts on a byte boundary.
+        row_bytes = (width * self.bitdepth + 7) // 8
+        if len(bytes) == row_bytes:
+            return unpack_samples(bytes, self.bitdepth, width)
         out = array('B')
-        mask = 2**self.bitdepth - 1
-        shifts = map(self.bitdepth.__mul__, reversed(range(spb)))
-        l = width
-        for o in bytes:
-            out.extend([(mask&(o>>s)) for s in shifts][:l])
-            l -= spb
-            if l <= 0:
-                l = width
+        for i in range(0, len(bytes), row_bytes):
+            out.extend(unpack_samples(bytes[i:i+row_bytes], self.bitdepth,
+                                      width))
         return out
 
     def iterstraight(self, raw):
@@ -1669,12 +2255,15 @@ class Reader:
         recon = None
         for some in raw:
             a.extend(some)
-            while len(a) >= rb + 1:
-                filter_type = a[0]
-                scanline = a[1:rb+1]
-                del a[:rb+1]
+            # Take all the complete rows, then drop them in one go.
+            start = 0
+            while len(a) - start >= rb + 1:
+                filter_type = a[start]
+                scanline = a[start+1:start+rb+1]
+                start += rb + 1
                 recon = self.undo_filter(filter_type, scanline, recon)
                 yield recon
+            del a[:start]
         if len(a) != 0:
             # :file:format We get here with a file format error: when the
             # available bytes (after decompressing) do not pack into exact
@@ -1683,6 +2272,22 @@ class Reader:
               'Wrong size for decompressed IDAT chunk.')
         assert len(a) == 0
 
+    def raw_size(self):
+        """The size in bytes of the decompressed image data, including
+        the filter type byte at the start of each row.
+        """
+
+        if not self.interlace:
+            return self.height * (self.row_bytes + 1)
+        size = 0
+        for xstart, ystart, xstep, ystep in _adam7:
+            if xstart >= self.width or ystart >= self.height:
+                continue
+            ppr = int(math.ceil((self.width-xstart)/float(xstep)))
+            rows = int(math.ceil((self.height-ystart)/float(ystep)))
+            size += rows * (1 + int(math.ceil(self.psize * ppr)))
+        return size
+
     def validate_signature(self):
         """If signature (header) has not been read then read and
         validate it; otherwise do nothing.
@@ -1860,17 +2465,27 @@ class Reader:
                 not self.colormap and len(data) != self.planes):
                 raise FormatError("sBIT chunk has incorrect length.")
 
-    def read(self, lenient=False):
+    def read(self, lenient=False, max_memory=None):
         """
         Read the PNG file and decode it.  Returns (`width`, `height`,
         `pixels`, `metadata`).
 
-        May use excessive memory.
+        Straightlaced images are decoded incrementally: ``IDAT`` data
+        is decompressed at most :attr:`decompress_size` bytes at a time
+        and each row is unfiltered as soon as it is complete.
+        Interlaced images have to be decoded whole, which may use
+        excessive memory.  Either way, decompressed data beyond the
+        size of the image is a :exc:`FormatError`, so a small file
+        cannot expand without bound.
 
         `pixels` are returned in boxed row flat pixel format.
 
         If the optional `lenient` argument evaluates to True,
         checksum failures will raise warnings rather than exceptions.
+
+        If `max_memory` is given, an :exc:`Error` is raised before any
+        pixel data is decompressed if decoding would need more than
+        about that many bytes of working memory.
         """
 
         def iteridat():
@@ -1896,28 +2511,57 @@ class Reader:
             be an iterator that yields the ``IDAT`` chunk data.
             """
 
-            # Currently, with no max_length paramter to decompress, this
-            # routine will do one yield per IDAT chunk.  So not very
-            # incremental.
             d = zlib.decompressobj()
-            # Each IDAT chunk is passed to the decompressor, then any
-            # remaining state is decompressed out.
+            remaining = raw_size
+            # Each IDAT chunk is passed to the decompressor in slices
+            # of bounded output, then any remaining state is
+            # decompressed out.
+            def check(out):
+                if len(out) > remaining:
+                    raise FormatError(
+                      'Decompressed IDAT data is larger than the image.')
+                return len(out)
             for data in idat:
-                # :todo: add a max_length argument here to limit output
-                # size.
-                yield array('B', d.decompress(data))
-            yield array('B', d.flush())
+                while data:
+                    out = d.decompress(data, self.decompress_size)
+                    data = d.unconsumed_tail
+                    remaining -= check(out)
+                    if out:
+                        yield array('B', out)
+            out = d.flush()
+            remaining -= check(out)
+            if out:
+                yield array('B', out)
 
         self.preamble(lenient=lenient)
+        raw_size = self.raw_size()
+        itemsize = 1 + (self.bitdepth > 8)
+        if max_memory is not None:
+            if self.interlace:
+                # The decompressed data and the whole image.
+                need = raw_size + \
+                  self.width * self.height * self.planes * itemsize
+            else:
+                # A slice, the pending data, and a couple of rows.
+                need = 2 * self.decompress_size + \
+                  4 * (self.row_bytes + 1) + \
+                  self.width * self.planes * itemsize
+            if need > max_memory:
+                raise Error(
+                  "decoding needs about %d bytes, more than max_memory (%d)"
+                  % (need, max_memory))
         raw = iterdecomp(iteridat())
 
         if self.interlace:
-            raw = array('B', itertools.chain(*raw))
-            arraycode = 'BH'[self.bitdepth>8]
-            # Like :meth:`group` but producing an array.array object for
-            # each row.
-            pixels = itertools.imap(lambda *row: array(arraycode, row),
-                       *[iter(self.deinterlace(raw))]*self.width*self.planes)
+            data = array('B')
+            for some in raw:
+                data.extend(some)
+            flat = self.deinterlace(data)
+            del data
+            def iterrows(vpr=self.width * self.planes):
+                for start in range(0, len(flat), vpr):
+                    yield flat[start:start+vpr]
+            pixels = iterrows()
         else:
             pixels = self.iterboxed(self.iterstraight(raw))
         meta = dict()
@@ -1948,8 +2592,53 @@ class Reader:
 
         x, y, pixel, meta = self.read()
         arraycode = 'BH'[meta['bitdepth']>8]
-        pixel = array(arraycode, itertools.chain(*pixel))
-        return x, y, pixel, meta
+        flat = array(arraycode)
+        for row in pixel:
+            # Rows are arrays of the same type, so this is a plain copy
+            flat.extend(row)
+        return x, y, flat, meta
+
+    def read_into(self, buffer, stride=None, offset=0):
+        """
+        Read a PNG file and decode it into `buffer`, which should be a
+        writable object supporting the buffer interface: a
+        ``bytearray``, a writable ``mmap`` (for example of the output
+        file), a numpy array, and so on.  Returns (*width*, *height*,
+        *metadata*).
+
+        The pixels are the same as those returned by :meth:`read`,
+        laid out as :meth:`Writer.write_buffer` expects: each sample is
+        1 byte for bit depths up to 8 and 2 bytes, big-endian, for 16.
+        Row *y* is stored at byte `offset` + *y* * `stride`; `stride`
+        defaults to the length of a row.
+        """
+
+        x, y, pixels, meta = self.read()
+        sample_bytes = 1 + (meta['bitdepth'] > 8)
+        row_bytes = x * meta['planes'] * sample_bytes
+        if stride is None:
+            stride = row_bytes
+        if stride < row_bytes:
+            raise ValueError("stride (%d) is less than the row length (%d)" %
+                             (stride, row_bytes))
+        needed = offset + (y - 1) * stride + row_bytes
+        view = writableview(buffer)
+        if len(view) < needed:
+            raise ValueError("buffer is too small, %d bytes are needed" %
+                             needed)
+        if isinstance(view, memoryview):
+            def store(start, row):
+                view[start:start+row_bytes] = bufferview(row)
+        else:
+            def store(start, row):
+                view[start:start+row_bytes] = tostring(row)
+        start = offset
+        for row in pixels:
+            if sample_bytes > 1 and sys.byteorder == 'little':
+                row.byteswap()
+            store(start, row)
+            start += stride
+        return x, y, meta
 
     def palette(self, alpha='natural'):
         """Returns a palette that is a sequence of 3-tuples or 4-tuples,
@@ -2311,6 +3000,170 @@ except:
     itertools.chain = _itertools_chain
 
 
+# === Support for users with NumPy ===
+
+# When NumPy can be imported it is used to filter and unfilter whole
+# scanlines at a time.  Filtering (when writing) only ever looks at
+# unfiltered data, so every filter type vectorises.  Undoing "sub" is a
+# running sum over each byte of the pixel, and undoing "up" is a single
+# addition.  Undoing "paeth" is a running sum too wherever the previous
+# line is flat, and only the bytes between such runs are done one at a
+# time.  Undoing "average" depends on the byte just reconstructed
+# everywhere, so NumPy doesn't help and it is still a loop, only over
+# lists rather than arrays.  The Cython extension, when it is present,
+# is still preferred for unfiltering, and is what makes reading images
+# that use "average" fast.
+
+class numpyfilters(object):
+    # Runs of at least this many bytes with b == c are undone in bulk
+    # by undo_filter_paeth; shorter ones aren't worth the NumPy calls.
+    min_run = 8
+
+    def asbytes(seq):
+        """Return `seq`, a sequence of bytes, as a NumPy ``uint8``
+        array.  Byte arrays are shared, not copied."""
+
+        if isarray(seq) and seq.typecode == 'B':
+            return numpy.frombuffer(seq, numpy.uint8)
+        return numpy.asarray(seq, numpy.uint8)
+    asbytes = staticmethod(asbytes)
+
+    def shifted(a, n):
+        """Return `a` moved right by `n` places, zero filled on the
+        left; this is the "a" (or "c") byte of each position."""
+
+        out = numpy.zeros_like(a)
+        out[n:] = a[:len(a)-n]
+        return out
+    shifted = staticmethod(shifted)
+
+    def filter_scanline(type, line, fo, prev):
+        """Filter `line` with filter type 1 to 4 (see
+        :func:`filter_scanline`).  Returns the filtered bytes, without
+        the filter type byte, as a string."""
+
+        x = numpyfilters.asbytes(line)
+        if type == 1:
+            return (x - numpyfilters.shifted(x, fo)).tostring()
+        b = numpyfilters.asbytes(prev)
+        if type == 2:
+            return (x - b).tostring()
+        a = numpyfilters.shifted(x, fo).astype(numpy.int16)
+        if type == 3:
+            pr = (a + b) >> 1
+        else:
+            b = b.astype(numpy.int16)
+            c = numpyfilters.shifted(b, fo)
+            pa = numpy.abs(b - c)
+            pb = numpy.abs(a - c)
+            pc = numpy.abs(a + b - c - c)
+            pr = numpy.where((pa <= pb) & (pa <= pc), a,
+                             numpy.where(pb <= pc, b, c))
+        return (x - pr.astype(numpy.uint8)).tostring()
+    filter_scanline = staticmethod(filter_scanline)
+
+    def undo_filter_sub(filter_unit, scanline, previous, result):
+        """Undo sub filter."""
+
+        r = numpyfilters.asbytes(result)
+        x = numpyfilters.asbytes(scanline)
+        n = len(r)
+        # Each byte of the pixel is an independent running sum, so
+        # lay the scanline out one pixel per row and sum the columns.
+        pad = -n % filter_unit
+        x = numpy.concatenate((x, numpy.zeros(pad, numpy.uint8)))
+        x = x.reshape(-1, filter_unit).cumsum(axis=0, dtype=numpy.uint8)
+        r[:] = x.reshape(-1)[:n]
+    undo_filter_sub = staticmethod(undo_filter_sub)
+
+    def undo_filter_up(filter_unit, scanline, previous, result):
+        """Undo up filter."""
+
+        r = numpyfilters.asbytes(result)
+        r[:] = numpyfilters.asbytes(scanline) + numpyfilters.asbytes(previous)
+    undo_filter_up = staticmethod(undo_filter_up)
+
+    def undo_filter_average(filter_unit, scanline, previous, result):
+        """Undo average filter."""
+
+        fu = filter_unit
+        x = list(scanline)
+        b = list(previous)
+        out = [(x[i] + (b[i] >> 1)) & 0xff for i in range(fu)]
+        append = out.append
+        # out[i] is the byte fu places to the left of the one appended.
+        i = 0
+        for xi, bi in itertools.izip(x[fu:], b[fu:]):
+            append((xi + ((out[i] + bi) >> 1)) & 0xff)
+            i += 1
+        result[:] = array('B', out)
+    undo_filter_average = staticmethod(undo_filter_average)
+
+    def undo_filter_paeth(filter_unit, scanline, previous, result):
+        """Undo Paeth filter."""
+
+        fu = filter_unit
+        b = numpyfilters.asbytes(previous).astype(numpy.int16)
+        if not b.any():
+            # Above the top of the image "paeth" is the same as "sub".
+            return numpyfilters.undo_filter_sub(fu, scanline,
+                                                previous, result)
+        x = numpyfilters.asbytes(scanline)
+        c = numpyfilters.shifted(b, fu)
+        # With p = a + b - c the three distances are |b - c|, |a - c|
+        # and |(a - c) + (b - c)|; only the last two depend on "a",
+        # the byte to the left in the line being reconstructed.  When
+        # b == c the predictor is always "a", so a run of such bytes is
+        # a running sum, like "sub", and is undone in one go.  Each
+        # byte of the pixel depends only on the same byte of the pixel
+        # to its left, so the bytes are worked through one at a time.
+        e = b - c
+        r = numpyfilters.asbytes(result)
+        for j in range(fu):
+            xj = x[j::fu]
+            bj = b[j::fu]
+            cj = c[j::fu]
+            ej = e[j::fu]
+            # Starts and ends of the runs of b == c, of at least
+            # min_run bytes, after the first pixel.
+            flat = numpy.concatenate(([False], ej[1:] == 0, [False]))
+            edges = numpy.flatnonzero(flat[1:] != flat[:-1]) + 1
+            starts = edges[0::2]
+            ends = edges[1::2]
+            bulk = ends - starts >= numpyfilters.min_run
+            runs = zip(starts[bulk].tolist(), ends[bulk].tolist())
+            runs.append((len(xj), len(xj)))
+            out = r[j::fu]
+            # On the first pixel "a" and "c" are 0, so "b" is predicted.
+            a = out[0] = (int(xj[0]) + int(bj[0])) & 0xff
+            i = 1
+            for start, end in runs:
+                if i < start:
+                    # Between the runs, one byte at a time.
+                    part = []
+                    append = part.append
+                    for xi, bi, ci, ei, pa in itertools.izip(
+                            xj[i:start].tolist(), bj[i:start].tolist(),
+                            cj[i:start].tolist(), ej[i:start].tolist(),
+                            numpy.abs(ej[i:start]).tolist()):
+                        if pa:
+                            d = a - ci
+                            pb = abs(d)
+                            pc = abs(d + ei)
+                            if pa > pb or pa > pc:
+                                a = bi if pb <= pc else ci
+                        a = (xi + a) & 0xff
+                        append(a)
+                    out[i:start] = part
+                if start < end:
+                    run = xj[start:end].cumsum(dtype=numpy.uint8)
+                    run += numpy.uint8(a)
+                    out[start:end] = run
+                    a = int(run[-1])
+                i = end
+    undo_filter_paeth = staticmethod(undo_filter_paeth)
+
+
 # === Support for users without Cython ===
 
 try:
@@ -2402,6 +3255,10 @@ except:
                 result[i::4] = row[i::3]
         convert_rgb_to_rgba = staticmethod(convert_rgb_to_rgba)
 
+    if numpy is not None:
+        class pngfilters(numpyfilters, pngfilters):
+            pass
+
 
 # === Internal Test Support ===
 
@@ -2643,6 +3500,95 @@ class Test(unittest.TestCase):
               interlace=True)
             x,y,pi,meta = Reader(bytes=pngs).read()
             self.assertEqual(map(list, ps), map(list, pi))
+    def testAdam7Sequence(self):
+        """Interlaced writing from an indexable sequence of rows gives
+        the same file as writing from an iterator."""
+        for planes, bitdepth in ((1, 8), (3, 8), (4, 16), (1, 2)):
+            w, h = 13, 11
+            maxval = 2**bitdepth - 1
+            rows = [array('BH'[bitdepth > 8],
+                          [(x*7 + y*3) & maxval for x in range(w*planes)])
+                    for y in range(h)]
+            args = dict(greyscale=planes < 3, alpha=planes == 4,
+                        bitdepth=bitdepth, interlace=True)
+            o = BytesIO()
+            Writer(w, h, **args).write(o, iter(rows))
+            a = o.getvalue()
+            o = BytesIO()
+            Writer(w, h, **args).write(o, rows)
+            self.assertEqual(o.getvalue(), a)
+            o = BytesIO()
+            Writer(w, h, **args).write(o, map(list, rows))
+            self.assertEqual(o.getvalue(), a)
+            self.assertRaises(ValueError, Writer(w, h, **args).write,
+                              BytesIO(), rows[1:])
+    def testWriteBuffer(self):
+        """write_buffer gives the same file as write, from padded rows
+        in a buffer."""
+        w, h = 7, 5
+        for planes, bitdepth, interlace in ((3, 8, False), (3, 8, True),
+                                            (2, 16, False), (4, 16, True),
+                                            (1, 4, True), (3, 5, False),
+                                            (1, 12, True)):
+            maxval = 2**bitdepth - 1
+            rows = [[(x*37 + y*11) & maxval for x in range(w*planes)]
+                    for y in range(h)]
+            args = dict(greyscale=planes < 3, alpha=planes in (2, 4),
+                        bitdepth=bitdepth, interlace=interlace)
+            stride = w*planes*(1 + (bitdepth > 8)) + 3
+            buf = bytearray(1 + h*stride)
+            for y, row in enumerate(rows):
+                if bitdepth > 8:
+                    row = struct.pack('>%dH' % len(row), *row)
+                else:
+                    row = struct.pack('%dB' % len(row), *row)
+                buf[1+y*stride:1+y*stride+len(row)] = row
+            o = BytesIO()
+            Writer(w, h, **args).write(o, rows)
+            a = o.getvalue()
+            o = BytesIO()
+            Writer(w, h, **args).write_buffer(o, buf, stride, 1)
+            self.assertEqual(o.getvalue(), a)
+            self.assertRaises(ValueError, Writer(w, h, **args).write_buffer,
+                              BytesIO(), buf, stride, 5)
+    def testReadInto(self):
+        """read_into stores the rows of read in a buffer."""
+        for name in ('basn2c16', 'basi0g04', 'basi6a08', 'basn3p04'):
+            x, y, pixels, meta = Reader(bytes=_pngsuite[name]).read()
+            rows = list(pixels)
+            stride = len(rows[0]) * (1 + (meta['bitdepth'] > 8)) + 2
+            buf = bytearray(y*stride)
+            r = Reader(bytes=_pngsuite[name]).read_into(buf, stride)
+            self.assertEqual(r[:2], (x, y))
+            o = BytesIO()
+            Writer(**meta).write_buffer(o, buf, stride)
+            self.assertEqual(map(list, Reader(bytes=o.getvalue()).read()[2]),
+                             map(list, rows))
+            self.assertRaises(ValueError,
+                              Reader(bytes=_pngsuite[name]).read_into,
+                              bytearray(y*stride - 3), stride)
+    def testPNMmmap(self):
+        """convert_pnm maps real files and reads the same image as from
+        a stream."""
+        data = strtobytes('P5 4 2 65535\n') + struct.pack('>8H',
+                 *[0, 1, 2, 300, 4000, 50000, 65535, 7])
+        f = tempfile.TemporaryFile()
+        try:
+            f.write(data)
+            f.seek(0)
+            read_pnm_header(f, ('P5',))
+            w = Writer(4, 2, greyscale=True, bitdepth=16)
+            mapped = BytesIO()
+            w.convert_pnm(f, mapped)
+        finally:
+            f.close()
+        s = BytesIO(data)
+        read_pnm_header(s, ('P5',))
+        o = BytesIO()
+        w.convert_pnm(s, o)
+        self.assertEqual(mapped.getvalue(), o.getvalue())
+        rows = list(Reader(bytes=o.getvalue()).read()[2])
+        self.assertEqual(list(rows[1]), [4000, 50000, 65535, 7])
     def testPGMin(self):
         """Test that the command line tool can read PGM files."""
         def do():
@@ -2812,6 +3758,41 @@ class Test(unittest.TestCase):
             chunk = (chunk[0], data)
             return chunk
         self.assertRaises(FormatError, self.helperFormat, eachchunk)
+    def testDecompressionBomb(self):
+        """Test file whose IDAT inflates to far more than the image.
+        The data is decompressed in slices and rejected early."""
+
+        def eachchunk(chunk):
+            if chunk[0] != 'IDAT':
+                return chunk
+            data = zlib.decompress(chunk[1])
+            data += strtobytes('\x00') * 2**24
+            return (chunk[0], zlib.compress(data))
+        decompress = zlib.decompressobj
+        sizes = []
+        class Recorder:
+            def __init__(self):
+                self.d = decompress()
+            def decompress(self, data, max_length=0):
+                out = self.d.decompress(data, max_length)
+                sizes.append(len(out))
+                return out
+            def __getattr__(self, name):
+                return getattr(self.d, name)
+        zlib.decompressobj = Recorder
+        try:
+            self.assertRaises(FormatError, self.helperFormat, eachchunk)
+        finally:
+            zlib.decompressobj = decompress
+        self.assertTrue(max(sizes) <= Reader.decompress_size)
+        self.assertTrue(sum(sizes) < 2 * Reader.decompress_size)
+    def testMaxMemory(self):
+        """read raises Error when decoding needs more than max_memory."""
+        r = Reader(bytes=_pngsuite['basi0g16'])
+        self.assertRaises(Error, r.read, max_memory=1000)
+        r = Reader(bytes=_pngsuite['basn0g16'])
+        rows = list(r.read(max_memory=2**18)[2])
+        self.assertEqual(len(rows), 32)
     def testNotEnoughPixels(self):
         def eachchunk(chunk):
             if chunk[0] != 'IDAT':
@@ -3000,6 +3981,184 @@ class Test(unittest.TestCase):
 
         out = reader.undo_filter(4, scanline, scanprev)
         self.assertEqual(list(out), [8, 10, 9, 108, 111, 113])  # paeth
+    def testFilterTypeWrite(self):
+        """Each filter_type strategy round-trips, including the first
+        scanline of every Adam7 pass and sub-byte and 16-bit depths."""
+        for type in (0, 1, 2, 3, 4, 'sum', 'brute'):
+            for interlace in (False, True):
+                for name in ('basn2c08', 'basn0g02', 'basn6a16',
+                             'basn3p04'):
+                    r = Reader(bytes=_pngsuite[name])
+                    x,y,pixels,info = r.read()
+                    pixels = map(list, pixels)
+                    info['interlace'] = interlace
+                    info['filter_type'] = type
+                    o = BytesIO()
+                    Writer(**info).write(o, pixels)
+                    again = Reader(bytes=o.getvalue()).read()[2]
+                    self.assertEqual(map(list, again), pixels)
+    def testFilterTypeSum(self):
+        """The 'sum' heuristic actually uses filters other than 0."""
+        rows = [range(i, i+48) for i in range(16)]
+        w = Writer(16, 16, filter_type='sum')
+        o = BytesIO()
+        w.write(o, rows)
+        data = zlib.decompress(Reader(bytes=o.getvalue()).chunk('IDAT')[1])
+        types = set(ord(data[i*49]) for i in range(16))
+        self.assertTrue(types - set([0]))
+    def testFilterTypeBad(self):
+        self.assertRaises(ValueError, Writer, 1, 1, filter_type=5)
+    def test16Bytes(self):
+        """pack_16 and unpack_16 agree with struct."""
+        values = [0, 1, 255, 256, 4660, 65535]
+        packed = struct.pack('>6H', *values)
+        self.assertEqual(pack_16(values), packed)
+        self.assertEqual(pack_16(array('H', values)), packed)
+        self.assertEqual(list(unpack_16(packed)), values)
+        self.assertEqual(list(unpack_16(array('B', packed))), values)
+        if numpy is not None:
+            self.assertEqual(pack_16(numpy.array(values, 'uint16')), packed)
+        o = BytesIO()
+        write_pnm(o, 3, 2, [values[:3], values[3:]],
+                  dict(bitdepth=16, planes=1))
+        self.assertEqual(o.getvalue(), strtobytes('P5 3 2 65535\n') + packed)
+    def testPackSamples(self):
+        """Packing and unpacking sub-byte samples round trips, and
+        agrees with doing it a sample at a time."""
+        import random
+        rnd = random.Random(5)
+        for bitdepth in (1, 2, 4):
+            spb = 8 // bitdepth
+            for width in (1, 7, 8, 9, 33):
+                row = [rnd.randrange(2**bitdepth) for i in range(width)]
+                packed = pack_samples(row, bitdepth)
+                padded = row + [0]*(-width % spb)
+                expected = [reduce(lambda x, y: (x << bitdepth) + y,
+                                   padded[i:i+spb])
+                            for i in range(0, len(padded), spb)]
+                self.assertEqual(list(packed), expected)
+                self.assertEqual(list(unpack_samples(packed, bitdepth,
+                                                     width)), row)
+                reader = Reader(bytes='')
+                reader.bitdepth = bitdepth
+                self.assertEqual(list(reader.serialtoflat(packed + packed,
+                                                          width)), row + row)
+    def testSbit(self):
+        """sbit writes an sBIT chunk and leaves the samples alone."""
+        o = BytesIO()
+        Writer(2, 1, sbit=5).write(o, [[8, 16, 24, 32, 40, 255]])
+        r = Reader(bytes=o.getvalue())
+        pixels = r.read()[2]
+        self.assertEqual(map(list, pixels), [[8, 16, 24, 32, 40, 255]])
+        self.assertEqual(r.sbit, strtobytes('\x05\x05\x05'))
+        self.assertRaises(ValueError, Writer, 1, 1, sbit=9)
+        self.assertRaises(ValueError, Writer, 1, 1, bitdepth=5, sbit=4)
+    def testStrategy(self):
+        """Each zlib strategy gives a file that reads back the same."""
+        rows = [[(x*y) & 0xff for x in range(30)] for y in range(20)]
+        for strategy in (zlib.Z_FILTERED, zlib.Z_HUFFMAN_ONLY, Z_RLE):
+            o = BytesIO()
+            Writer(30, 20, greyscale=True, strategy=strategy,
+                   filter_type='sum').write(o, rows)
+            pixels = Reader(bytes=o.getvalue()).read()[2]
+            self.assertEqual(map(list, pixels), rows)
+    def testParallelCompressor(self):
+        """Blocks compressed separately make one valid zlib stream."""
+        import random
+        rnd = random.Random(3)
+        data = strtobytes('').join(
+          chr(rnd.randrange(4)) * rnd.randrange(1, 300)
+          for i in range(4000))
+        for level in (None, 1, 9):
+            compressor = ParallelCompressor(level, 3)
+            out = []
+            for i in range(0, len(data), 70000):
+                out.append(compressor.compress(data[i:i+70000]))
+            out.append(compressor.flush())
+            self.assertEqual(zlib.decompress(strtobytes('').join(out)), data)
+    def testThreads(self):
+        """An image big enough to be compressed on several threads
+        reads back the same as one compressed on one."""
+        w, h = 1024, 1100
+        rows = [[(x*y + y) & 0xff for x in range(w)] for y in range(h)]
+        files = []
+        for threads in (1, 3):
+            o = BytesIO()
+            writer = Writer(w, h, greyscale=True, threads=threads)
+            self.assertEqual(writer.parallel_compression(), threads != 1)
+            writer.write(o, rows)
+            files.append(o.getvalue())
+        self.assertNotEqual(files[0], files[1])
+        for data in files:
+            pixels = Reader(bytes=data).read()[2]
+            self.assertEqual(map(list, pixels), rows)
+        self.assertRaises(ValueError, Writer, 1, 1, threads=-1)
+    def testWriteFiltered(self):
+        """Data filtered once can be compressed in several ways."""
+        rows = [[(x*y + y) & 0xff for x in range(40)] for y in range(30)]
+        writer = Writer(40, 30, greyscale=True, filter_type='sum',
+                        chunk_limit=200)
+        filtered = list(writer.iter_filtered(rows))
+        self.assertTrue(len(filtered) > 1)
+        for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_HUFFMAN_ONLY):
+            o = BytesIO()
+            Writer(40, 30, greyscale=True, strategy=strategy,
+                   chunk_limit=200).write_filtered(o, filtered)
+            pixels = Reader(bytes=o.getvalue()).read()[2]
+            self.assertEqual(map(list, pixels), rows)
+    def testThreadsStopped(self):
+        """The compression threads are stopped when the rows raise."""
+        import threading
+        w, h = 1024, 1100
+        def rows():
+            for y in range(h // 2):
+                yield [y & 0xff] * w
+            raise ValueError('bad row')
+        before = threading.active_count()
+        writer = Writer(w, h, greyscale=True, threads=3)
+        self.assertRaises(ValueError, writer.write, BytesIO(), rows())
+        self.assertEqual(threading.active_count(), before)
+    def testSumCost(self):
+        """sum_cost agrees with the plain per byte sum, with and without
+        NumPy."""
+        global numpy
+        line = array('B', range(256) + [0, 255, 128, 1])
+        expected = sum(_signed_abs[x] for x in line[1:])
+        self.assertEqual(sum_cost(line), expected)
+        saved, numpy = numpy, None
+        try:
+            self.assertEqual(sum_cost(line), expected)
+        finally:
+            numpy = saved
+    def testNumpyFilters(self):
+        """The NumPy filters agree with the pure Python ones, and undoing
+        a filter gives back the original scanline."""
+        global numpy
+        if numpy is None:
+            print >>sys.stderr, "skipping numpy test"
+            return
+        import random
+        rnd = random.Random(7)
+        for fo in (1, 2, 3, 4, 6, 8):
+            prev = array('B', [rnd.randrange(256) for i in range(240)])
+            line = array('B', [(x + rnd.randrange(-4, 5)) & 0xff
+                               for x in prev])
+            # Flat runs exercise the b == c case of paeth, long enough
+            # to be undone in bulk.
+            prev[30:200] = array('B', [17]*170)
+            reader = Reader(bytes='')
+            reader.psize = fo
+            for type in range(5):
+                for p in (prev, array('B', [0]*len(prev))):
+                    saved, numpy = numpy, None
+                    try:
+                        expected = filter_scanline(type, line, fo, p)
+                    finally:
+                        numpy = saved
+                    out = filter_scanline(type, line, fo, p)
+                    self.assertEqual(list(out), list(expected))
+                    undone = reader.undo_filter(type, out[1:], p)
+                    self.assertEqual(list(undone), list(line))
     def testIterstraight(self):
         def arraify(list_of_str):
             return [array('B', s) for s in list_of_str]
@@ -3703,16 +4862,13 @@ def write_pnm(file, width, height, pixels, meta):
         file.write('P7\nWIDTH %d\nHEIGHT %d\nDEPTH %d\nMAXVAL %d\n'
                    'TUPLTYPE %s\nENDHDR\n' %
                    (width, height, planes, maxval, tupltype))
-    # Values per row
-    vpr = planes * width
-    # struct format
-    fmt = '>%d' % vpr
-    if maxval > 0xff:
-        fmt = fmt + 'H'
-    else:
-        fmt = fmt + 'B'
     for row in pixels:
-        file.write(struct.pack(fmt, *row))
+        if maxval > 0xff:
+            file.write(pack_16(row))
+        else:
+            if not isarray(row):
+                row = array('B', row)
+            file.write(tostring(row))
     file.flush()
 
 def color_triple(color):
@@ -3753,6 +4909,14 @@ def _add_common_options(parser):
     parser.add_option("-c", "--compression",
                       action="store", type="int", metavar="level",
                       help="zlib compression level (0-9)")
+    parser.add_option("-f", "--filter",
+                      action="store", type="string", metavar="type",
+                      default="0",
+                      help="scanline filter: 0-4, sum, or brute")
+    parser.add_option("-j", "--threads",
+                      action="store", type="int", metavar="count",
+                      default=1,
+                      help="compression threads, 0 for one per processor")
     return parser
 
 def _main(argv):
@@ -3781,6 +4945,8 @@ def _main(argv):
         options.transparent = color_triple(options.transparent)
     if options.background is not None:
         options.background = color_triple(options.background)
+    if options.filter.isdigit():
+        options.filter = int(options.filter)
 
     # Prepare input and output files
     if len(args) == 0:
@@ -3829,7 +4995,9 @@ def _main(argv):
                         background=options.background,
                         alpha=bool(pamalpha or options.alpha),
                         gamma=options.gamma,
-                        compression=options.compression)
+                        compression=options.compression,
+                        filter_type=options.filter,
+                        threads=options.threads)
         if options.alpha:
             pgmfile = open(options.alpha, 'rb')
             format, awidth, aheight, adepth, amaxval = \
@@ -1,10 +1,36 @@
 from __future__ import division
 
 import re
+import ast
 import os.path
 
 builtins = {'str': str, 'int': int, 'slice': slice, 'float': float}
-image_num = 0
+# What a pattern can refer to, besides builtins
+variables = ('name', 'ext', 'n')
+# Everything a <...> expression may be made of; anything else, like
+# lambdas or comprehensions, is refused
+allowed_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp,
+                 ast.Compare, ast.IfExp, ast.Call, ast.Subscript, ast.Index,
+                 ast.Slice, ast.Attribute, ast.Name, ast.Load, ast.Num,
+                 ast.Str, ast.Tuple, ast.operator, ast.unaryop, ast.boolop,
+                 ast.cmpop)
+field_re = re.compile('<(.*?)>')
+# Attributes refused besides private ones; str.format can reach private
+# attributes through its replacement fields, as in '{0.__class__}'
+forbidden_attributes = ('format',)
+
+
+class RenameError(ValueError):
+    pass
+
+
+def split_name(filename):
+    """os.path.splitext for a name without a directory, but quicker."""
+    dot = filename.rfind('.')
+    if dot <= 0 or filename[dot - 1] == '.' and not filename[:dot].strip('.'):
+        return filename, ''
+    return filename[:dot], filename[dot:]
+
 
 def sortkey(s):
     parts = re.findall(r'(\d+|[^\d]+)', os.path.splitext(s)[0])
@@ -14,27 +40,148 @@ def sortkey(s):
     return parts
 
 
-def replace(globals_dict, matchobj, base=10):
-    globals_dict['__builtins__'] = builtins
-    
-    form = matchobj.group(1).lower()
-    if ';' in form:
-        width, form = form.split(';', 1)
-    else:
-        width = 'pad'
-        
-    if width == 'pad':
-        width = len(str(image_num))
-    elif width != 'nopad':
-        try:
-            width = int(width)
-        except ValueError:
-            width = 0
-        
-    value = eval(form, globals_dict)
-    if isinstance(value, int) or isinstance(value, float):
+def check_expression(form):
+    """Parse form and make sure it only uses what a pattern may."""
+    try:
+        tree = ast.parse(form, mode='eval')
+    except SyntaxError:
+        raise RenameError('<%s> is not a valid expression' % form)
+    for node in ast.walk(tree):
+        if not isinstance(node, allowed_nodes):
+            raise RenameError('<%s> uses something not allowed in a '
+                              'pattern' % form)
+        if (isinstance(node, ast.Name) and node.id not in variables and
+            node.id not in builtins):
+            raise RenameError("<%s> uses unknown name '%s'" % (form, node.id))
+        if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            raise RenameError("<%s> uses private attribute '%s'" %
+                              (form, node.attr))
+        if isinstance(node, ast.Attribute) and (node.attr in
+                                                forbidden_attributes):
+            raise RenameError("<%s> uses '%s', which is not allowed in a "
+                              "pattern" % (form, node.attr))
+        if isinstance(node, ast.Call) and (node.keywords or node.starargs or
+                                           node.kwargs):
+            raise RenameError('<%s> passes keyword or * arguments' % form)
+    return tree.body
+
+
+class FieldInserter(ast.NodeTransformer):
+    """Replaces the names field0, field1 and so on with the checked
+    expressions of the fields, so they are never pasted in as text."""
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def visit_Name(self, node):
+        if node.id.startswith('field'):
+            return self.fields[int(node.id[5:])]
+        return node
+
+
+def value_type(node):
+    """Return int or str if the expression node always gives that type,
+    otherwise None."""
+    if isinstance(node, ast.Num) or (isinstance(node, ast.Name) and
+                                     node.id == 'n'):
+        return int
+    if isinstance(node, ast.Str) or (isinstance(node, ast.Name) and
+                                     node.id in ('name', 'ext')):
+        return str
+    if isinstance(node, ast.BinOp):
+        left, right = value_type(node.left), value_type(node.right)
+        if left is right is int:
+            return int
+        if left is right is str and isinstance(node.op, ast.Add):
+            return str
+    if isinstance(node, ast.UnaryOp) and value_type(node.operand) is int:
+        return int
+    if (isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Slice)
+        and value_type(node.value) is str):
+        return str
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+        node.func.id in ('int', 'float', 'str')):
+        return (str if node.func.id == 'str' else int)
+    return None
+
+
+def format_field(value, width, form):
+    if isinstance(value, (int, long, float)):
         if width == 'nopad':
-            value = '%d' % value
-        else:
-            value = '%0*d' % (width, value)
+            return '%d' % value
+        return '%0*d' % (width, value)
+    if not isinstance(value, basestring):
+        raise RenameError('<%s> gives %r, not text or a number' %
+                          (form, value))
     return value
+
+
+class Template(object):
+    """A rename pattern such as 'photo_<3;n+1><ext>', parsed and checked
+    once and then applied to any number of files.
+
+    Each <...> field is an expression of name, ext and n, optionally
+    preceded by a padding width, PAD or NOPAD and a ';'.  The fields are
+    checked and compiled together into one function, so renaming a file
+    is a single call and a string format.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        pieces = field_re.split(text)
+        # Literal text, with the fields replaced by %s
+        self.format = '%s'.join(piece.replace('%', '%%')
+                                for piece in pieces[0::2])
+        calls = []
+        fields = []
+        for form in pieces[1::2]:
+            form = form.lower()
+            if ';' in form:
+                width, form = form.split(';', 1)
+            else:
+                width = 'pad'
+            if width not in ('pad', 'nopad'):
+                try:
+                    width = int(width)
+                except ValueError:
+                    raise RenameError('padding of <%s;%s> should be a '
+                                      'number, PAD or NOPAD' % (width, form))
+            field = check_expression(form)
+            # PAD is worked out from the number of files, see rename
+            width_arg = 'pad' if width == 'pad' else repr(width)
+            # Fields whose type is known are formatted inline
+            kind = value_type(field)
+            if kind is str:
+                calls.append('field%d, ' % len(fields))
+            elif kind is int and width == 'nopad':
+                calls.append("'%%d' %% field%d, " % len(fields))
+            elif kind is int:
+                calls.append("'%%0*d' %% (%s, field%d), " % (width_arg,
+                                                            len(fields)))
+            else:
+                calls.append('_format(field%d, %s, %r), ' % (len(fields),
+                                                             width_arg, form))
+            fields.append(field)
+        tree = ast.parse('lambda name, ext, n, pad: (%s)' % ''.join(calls),
+                         mode='eval')
+        tree = ast.fix_missing_locations(FieldInserter(fields).visit(tree))
+        namespace = {'__builtins__': builtins, '_format': format_field}
+        self.function = eval(compile(tree, '<rename pattern>', 'eval'),
+                             namespace)
+
+    def rename(self, filenames):
+        """Return a dict of the new name of each of filenames, numbered
+        in order from 0."""
+        pad = len(str(len(filenames)))
+        format = self.format
+        function = self.function
+        names = {}
+        try:
+            for n, filename in enumerate(filenames):
+                name, ext = split_name(filename)
+                names[filename] = format % function(name, ext, n, pad)
+        except RenameError:
+            raise
+        except Exception as e:
+            raise RenameError('%s for %s: %s' % (self.text, filename, e))
+        return names
@@ -0,0 +1,291 @@
+import os
+import threading
+import multiprocessing
+from functools import partial
+from Queue import Queue, Empty
+from multiprocessing import Pool, cpu_count
+from multiprocessing.queues import SimpleQueue
+
+
+# Seconds imap_bounded waits for a result before checking for tasks
+# lost with their worker
+poll_interval = 0.5
+# Queue the workers of a WorkerPool report the tasks they start on
+task_started = None
+# Number of the workers of a WorkerPool running a task, shared by them
+busy_workers = None
+
+
+def init_tracked(started, busy, initializer):
+    """Pool initializer of WorkerPool's workers."""
+    global task_started, busy_workers
+    task_started = started
+    busy_workers = busy
+    if initializer is not None:
+        initializer()
+
+
+def run_tracked(task_id, func, args):
+    """Pool task of WorkerPool.submit, tells the parent which worker runs
+    the task before running it."""
+    task_started.put((task_id, os.getpid()))
+    with busy_workers.get_lock():
+        busy_workers.value += 1
+    try:
+        return func(*args)
+    finally:
+        with busy_workers.get_lock():
+            busy_workers.value -= 1
+
+
+def free_cores():
+    """In a worker of a WorkerPool, the number of cores that no worker is
+    running a task on; None in other processes.  A task can use that
+    many threads besides its own without slowing the others down."""
+    if busy_workers is None:
+        return None
+    return max(cpu_count() - busy_workers.value, 0)
+
+
+class WorkerPool(object):
+    """A multiprocessing pool that is started the first time it is
+    needed and then kept for later batches, so only the first batch pays
+    for starting the workers and running initializer in each of them.
+
+    Tasks sent with submit are tracked, so that tasks that raised, or
+    whose worker died (crashed in a decoder, or was killed for using too
+    much memory), can be found with failed_tasks and lost_tasks rather
+    than waited for for ever.
+    """
+    def __init__(self, initializer=None):
+        self.initializer = initializer
+        self.pool = None
+        self.size = 0
+        self.lock = threading.Lock()
+        self.started = None
+        self.broken = False
+        self.next_id = 0
+        # Worker pid of each started task that hasn't finished
+        self.running = {}
+        # Tasks finished before their start was seen
+        self.finished = set()
+        # Running tasks whose worker was found dead at the last check
+        self.suspects = set()
+        # AsyncResult of each task submitted and not known to be done
+        self.results = {}
+
+    def get(self, workers=None):
+        """Return the pool, starting it if needed.  workers is the number
+        of processes wanted, 0 or None for one per core.  The pool is
+        restarted if that has changed, or if it lost tasks."""
+        workers = workers or cpu_count()
+        with self.lock:
+            if self.pool is not None and (self.size != workers or
+                                          self.broken):
+                self.stop()
+            if self.pool is None:
+                # Written straight to the pipe, so the report of a task
+                # gets through even if its worker dies right after
+                self.started = SimpleQueue()
+                self.pool = Pool(workers, init_tracked,
+                                 (self.started, multiprocessing.Value('i'),
+                                  self.initializer))
+                self.size = workers
+                self.broken = False
+                self.running.clear()
+                self.finished.clear()
+                self.suspects.clear()
+                self.results.clear()
+            return self.pool
+
+    def submit(self, func, args, callback):
+        """Run func(*args) in the pool and call callback with the id of
+        the task and the result.  Returns the id."""
+        with self.lock:
+            task_id = self.next_id
+            self.next_id += 1
+        result = self.pool.apply_async(run_tracked, (task_id, func, args),
+                                       callback=partial(self.task_done,
+                                                        task_id, callback))
+        with self.lock:
+            self.results[task_id] = result
+        return task_id
+
+    def task_done(self, task_id, callback, result):
+        with self.lock:
+            # Reading the reports as results come in keeps the workers
+            # from blocking on a full pipe
+            self.read_started()
+            self.forget(task_id)
+        callback(task_id, result)
+
+    def read_started(self):
+        while not self.started.empty():
+            task_id, pid = self.started.get()
+            if task_id in self.finished:
+                self.finished.discard(task_id)
+            else:
+                self.running[task_id] = pid
+
+    def forget(self, task_id):
+        if self.running.pop(task_id, None) is None:
+            # Its start is still to be read
+            self.finished.add(task_id)
+
+    def failed_tasks(self):
+        """Return (id, exception) for each task that raised; their
+        callbacks will never be called."""
+        failed = []
+        with self.lock:
+            for task_id, result in self.results.items():
+                # The callback of a task that succeeded may not have run
+                # yet, so those are only dropped here
+                if result.ready():
+                    del self.results[task_id]
+                    if not result.successful():
+                        self.forget(task_id)
+                        try:
+                            result.get()
+                        except Exception as e:
+                            failed.append((task_id, e))
+        return failed
+
+    def lost_tasks(self):
+        """Return the ids of the tasks whose worker died while running
+        them; their callbacks will never be called.  A task is only given
+        up on when its worker is still gone at a second check, so that
+        a result already on its way is not mistaken for a lost one."""
+        with self.lock:
+            self.read_started()
+            alive = set(process.pid
+                        for process in multiprocessing.active_children())
+            lost = []
+            suspects = set()
+            for task_id, pid in self.running.items():
+                if pid not in alive:
+                    if task_id in self.suspects:
+                        lost.append(task_id)
+                        del self.running[task_id]
+                        self.results.pop(task_id, None)
+                    else:
+                        suspects.add(task_id)
+            self.suspects = suspects
+            if lost:
+                # The pool still counts them as outstanding, so it could
+                # not be closed cleanly
+                self.broken = True
+            return lost
+
+    def stop(self):
+        if self.broken:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+    def close(self):
+        """Let queued tasks finish, then stop the workers."""
+        with self.lock:
+            if self.pool is not None:
+                self.stop()
+
+    def terminate(self):
+        """Stop the workers straight away."""
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+
+def imap_bounded(pool, func, tasks, window, budget=None, weigh=None,
+                 on_error=None):
+    """Run func(*args) in pool, a started WorkerPool, for each args in
+    tasks and yield the results in the order they complete.
+
+    tasks is consumed lazily and at most window tasks are submitted but
+    not yet yielded, so neither queued tasks nor finished results pile
+    up in the parent however many tasks there are.
+
+    If budget is given, weigh(args) is the memory a task needs, and
+    tasks are only started while the weights of those running add up to
+    no more than budget; a task on its own always runs.  When the next
+    task doesn't fit, later ones that fit are started instead, so small
+    tasks keep going while a big one waits for memory.  At most window
+    tasks are started ahead of a waiting one, so it isn't kept waiting
+    for ever.
+
+    If a task raises, or the worker running it dies, on_error(args,
+    exception) is yielded in place of its result, where exception is a
+    RuntimeError for a dead worker.  Without on_error the exception is
+    raised.
+    """
+    done = Queue()
+    tasks = iter(tasks)
+    # (weight, args) read ahead of being started, at most window of them
+    held = []
+    # (weight, args) of each task started but not yet yielded, by id
+    started = {}
+    in_use = 0
+    # Tasks started ahead of held[0]
+    passed = 0
+    while True:
+        while len(started) < window:
+            while len(held) < window:
+                try:
+                    args = next(tasks)
+                except StopIteration:
+                    break
+                weight = 0 if budget is None else min(weigh(args), budget)
+                held.append((weight, args))
+            if not held:
+                break
+            if budget is None or not started:
+                index = 0
+            else:
+                index = None
+                for i, (weight, args) in enumerate(held):
+                    if i and passed >= window:
+                        break
+                    if in_use + weight <= budget:
+                        index = i
+                        break
+                if index is None:
+                    break
+            if index:
+                passed += 1
+            else:
+                passed = 0
+            weight, args = held.pop(index)
+            task_id = pool.submit(func, args,
+                                  lambda task_id, result:
+                                  done.put((task_id, result)))
+            started[task_id] = weight, args
+            in_use += weight
+
+        if not started:
+            break
+        try:
+            finished = [done.get(timeout=poll_interval)]
+        except Empty:
+            finished = []
+            failed = [(task_id, RuntimeError('Worker process died'))
+                      for task_id in pool.lost_tasks()]
+        else:
+            failed = []
+        # Hand over anything else that is already finished
+        while True:
+            try:
+                finished.append(done.get_nowait())
+            except Empty:
+                break
+        failed.extend(pool.failed_tasks())
+        for task_id, error in failed:
+            if on_error is None:
+                raise error
+            finished.append((task_id, on_error(started[task_id][1], error)))
+        for task_id, result in finished:
+            weight, args = started.pop(task_id)
+            in_use -= weight
+            yield result
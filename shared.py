@@ -8,4 +8,4 @@ format_dict = {'JPEG': {'optimize': True, 'quality': 95},
               }
 
 options = {'format': 'JPEG', 'archive': False, 'src_dir': '', 'dest_dir': '',
-           'extensions': True}
+           'extensions': True, 'workers': 0, 'memory_limit': 0}
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from PIL import Image
+
+import png
+import images
+
+
+class TestSavePNG(unittest.TestCase):
+    def check_background(self, options):
+        im = Image.linear_gradient('L').resize((40, 30))
+        outfile = BytesIO()
+        images.save_as_PNG(im, outfile, options)
+        reader = png.Reader(bytes=outfile.getvalue())
+        rows = list(reader.asDirect()[2])
+        self.assertEqual(len(rows), 30)
+        return reader
+
+    def testGreyBackground(self):
+        for options in ({'optimize': True, 'optimize_attempts': 3},
+                        {'interlace': True}, {}):
+            options['background'] = (255, 255, 255)
+            reader = self.check_background(options)
+            self.assertEqual(reader.background, (255,))
+
+    def testGreyLowBitBackground(self):
+        im = Image.new('L', (8, 8), 0)
+        im.paste(255, (0, 0, 4, 8))
+        outfile = BytesIO()
+        images.save_as_PNG(im, outfile, {'background': (255, 255, 255),
+                                         'interlace': True})
+        reader = png.Reader(bytes=outfile.getvalue())
+        reader.preamble()
+        self.assertEqual(reader.bitdepth, 1)
+        self.assertEqual(reader.background, (1,))
+
+    def testOptimizeAttempts(self):
+        im = Image.linear_gradient('L').resize((64, 48)).convert('RGB')
+        writer_args = images.png_writer_args(im, {'optimize': True})[1]
+        best = images.optimize_PNG(im, writer_args, 0, threads=1)
+        self.assertEqual(images.optimize_PNG(im, writer_args, 0, threads=3),
+                         best)
+        first = images.optimize_PNG(im, writer_args, 1)
+        self.assertLessEqual(len(best), len(first))
+        self.assertEqual(images.optimize_PNG(im, writer_args, 1), first)
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def testBudget(self):
+        self.assertEqual(images.memory_budget(100), 100 << 20)
+        memory = images.physical_memory()
+        self.assertTrue(memory > 0)
+        self.assertEqual(images.memory_budget(0), memory // 2)
+
+
+class TestGrayscale(unittest.TestCase):
+    def testModes(self):
+        for mode in ('1', 'L', 'LA', 'I', 'F', 'I;16'):
+            self.assertTrue(images.is_grayscale(Image.new(mode, (4, 4))))
+        red = Image.new('RGB', (4, 4), (255, 0, 0))
+        grey = Image.new('RGB', (4, 4), (90, 90, 90))
+        for mode in ('CMYK', 'YCbCr', 'HSV', 'P', 'RGBA'):
+            self.assertFalse(images.is_grayscale(red.convert(mode)), mode)
+            self.assertTrue(images.is_grayscale(grey.convert(mode)), mode)
+        self.assertTrue(images.is_grayscale(Image.new('LAB', (4, 4),
+                                                      (50, 128, 128))))
+        self.assertFalse(images.is_grayscale(Image.new('LAB', (4, 4),
+                                                       (50, 200, 128))))
+
+    def testCacheBounded(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        images.grayscale_cache.clear()
+        im = Image.new('RGB', (4, 4))
+        for i in range(images.grayscale_cache_size + 5):
+            path = os.path.join(directory, '%d.png' % i)
+            im.save(path)
+            self.assertTrue(images.cached_is_grayscale(path, im))
+        self.assertEqual(len(images.grayscale_cache),
+                         images.grayscale_cache_size)
+        # The oldest go first
+        self.assertNotIn(os.path.join(directory, '0.png'),
+                         [key[0] for key in images.grayscale_cache])
+        images.grayscale_cache.clear()
+
+
+class TestCost(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testDecodedSize(self):
+        # Small file, big image: the budget must not go by the file size
+        path = os.path.join(self.dir, 'flat.png')
+        Image.new('RGB', (1000, 800)).save(path)
+        self.assertLess(os.path.getsize(path), 1 << 20)
+        self.assertEqual(images.decoded_size(path), 1000 * 800 * 3)
+        path = os.path.join(self.dir, 'broken.png')
+        with open(path, 'wb') as outfile:
+            outfile.write(b'not a png')
+        self.assertEqual(images.decoded_size(path),
+                         images.estimate_cost(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
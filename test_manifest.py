@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from manifest import Manifest, source_state
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name in ('src1', 'src2', 'dest'):
+            os.mkdir(os.path.join(self.dir, name))
+        self.dest = os.path.join(self.dir, 'dest')
+        with open(os.path.join(self.dest, 'a.jpg'), 'wb') as outfile:
+            outfile.write(b'converted')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def source(self, folder, data):
+        path = os.path.join(self.dir, folder, 'a.png')
+        with open(path, 'wb') as outfile:
+            outfile.write(data)
+        return path
+
+    def testSourcePaths(self):
+        first = self.source('src1', b'first')
+        second = self.source('src2', b'other')
+        manifest = Manifest(self.dest)
+        manifest.update(first, source_state(first), 'settings', 'a.jpg')
+        manifest.save()
+        manifest = Manifest(self.dest)
+        self.assertTrue(manifest.is_current(first, 'settings'))
+        self.assertFalse(manifest.is_current(first, 'other settings'))
+        # Same filename in another folder
+        self.assertFalse(manifest.is_current(second, 'settings'))
+
+    def testChanged(self):
+        path = self.source('src1', b'first')
+        manifest = Manifest(self.dest)
+        manifest.update(path, source_state(path), 'settings', 'a.jpg')
+        self.source('src1', b'fir5t')
+        os.utime(path, (0, 0))
+        self.assertFalse(manifest.is_current(path, 'settings'))
+        manifest.update(path, None, 'settings', 'a.jpg')
+        self.assertEqual(manifest.entries, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
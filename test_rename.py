@@ -0,0 +1,29 @@
+import unittest
+
+from rename import Template, RenameError
+
+
+class TestTemplate(unittest.TestCase):
+    def testRename(self):
+        files = ['a.png', 'b.jpg', 'c']
+        names = Template('photo_<n+1><ext>').rename(files)
+        self.assertEqual(names, {'a.png': 'photo_1.png',
+                                 'b.jpg': 'photo_2.jpg', 'c': 'photo_3'})
+        names = Template('<name.upper()>_<3;n><ext>').rename(files)
+        self.assertEqual(names['b.jpg'], 'B_001.jpg')
+        names = Template('<nopad;n>_<name>').rename(files)
+        self.assertEqual(names['c'], '2_c')
+
+    def testRefused(self):
+        for text in ('<__import__("os")>', '<name.__class__>',
+                     '<"{0.__class__}".format(n)>', '<str.format("{0}", n)>',
+                     '<[x for x in name]>', '<lambda: 1>', '<open>',
+                     '<x;n>', '<n +>'):
+            self.assertRaises(RenameError, Template, text)
+
+    def testBadValue(self):
+        self.assertRaises(RenameError, Template('<n / 0>').rename, ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import unittest
+
+import scheduler
+
+
+def name_of(name, weight):
+    return name
+
+
+def free_cores(name, weight):
+    return scheduler.free_cores()
+
+
+def crash(name, weight):
+    if name == 'gone':
+        os._exit(1)
+    if name == 'bad':
+        raise IOError('bad file')
+    return name
+
+
+class FakePool(object):
+    """Stands in for a WorkerPool.  Tasks only finish, oldest first or
+    newest first, when imap_bounded gives up waiting and checks for lost
+    tasks, so what it starts alongside what can be followed exactly."""
+
+    def __init__(self, newest_first=False):
+        self.newest_first = newest_first
+        self.running = []
+        self.failed = []
+        self.next_id = 0
+        # Names of the tasks already running as each task was started
+        self.log = []
+
+    def submit(self, func, args, callback):
+        task_id = self.next_id
+        self.next_id += 1
+        self.log.append((args[0], [task[1][0] for task in self.running]))
+        self.running.append((task_id, args, func, callback))
+        return task_id
+
+    def lost_tasks(self):
+        task_id, args, func, callback = self.running.pop(
+            -1 if self.newest_first else 0)
+        try:
+            callback(task_id, func(*args))
+        except IOError as e:
+            self.failed.append((task_id, e))
+        return []
+
+    def failed_tasks(self):
+        failed, self.failed = self.failed, []
+        return failed
+
+
+class TestImapBounded(unittest.TestCase):
+    def setUp(self):
+        self.poll_interval = scheduler.poll_interval
+        scheduler.poll_interval = 0.001
+
+    def tearDown(self):
+        scheduler.poll_interval = self.poll_interval
+
+    def run_tasks(self, pool, tasks, window=4, budget=10, func=name_of,
+                  on_error=None):
+        return list(scheduler.imap_bounded(pool, func, tasks, window,
+                                           budget, lambda args: args[1],
+                                           on_error))
+
+    def testHeldBack(self):
+        pool = FakePool()
+        tasks = [('big1', 8), ('big2', 8), ('small1', 1), ('small2', 1)]
+        results = self.run_tasks(pool, tasks)
+        self.assertEqual(sorted(results), sorted(name for name, w in tasks))
+        # The small ones go ahead of big2, which waits for big1
+        self.assertEqual(pool.log, [('big1', []),
+                                    ('small1', ['big1']),
+                                    ('small2', ['big1', 'small1']),
+                                    ('big2', ['small1', 'small2'])])
+
+    def testPassedLimit(self):
+        # big1 runs until nothing else does, and small tasks would keep
+        # going ahead of big2 if their number wasn't limited
+        pool = FakePool(newest_first=True)
+        tasks = [('big1', 8), ('big2', 8)] + [('small', 1)] * 6
+        self.run_tasks(pool, tasks, window=3)
+        started = [name for name, running in pool.log]
+        self.assertEqual(started.index('big2'), 4)
+
+    def testOverBudget(self):
+        pool = FakePool()
+        tasks = [('a', 1), ('huge', 50), ('b', 1)]
+        results = self.run_tasks(pool, tasks)
+        self.assertEqual(sorted(results), ['a', 'b', 'huge'])
+        self.assertIn(('huge', []), pool.log)
+
+    def testFailed(self):
+        pool = FakePool()
+        tasks = [('a', 1), ('bad', 1), ('b', 1)]
+        results = self.run_tasks(pool, tasks, func=crash,
+                                 on_error=lambda args, e: (args[0], str(e)))
+        self.assertEqual(sorted(results), ['a', 'b', ('bad', 'bad file')])
+        self.assertRaises(IOError, self.run_tasks, FakePool(), tasks,
+                          func=crash)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def testFailedAndLost(self):
+        pool = scheduler.WorkerPool()
+        try:
+            pool.get(2)
+            tasks = [(name, 1) for name in ('a', 'bad', 'gone', 'b')]
+            results = list(scheduler.imap_bounded(
+                pool, crash, tasks, 4,
+                on_error=lambda args, e: (args[0], str(e))))
+            self.assertEqual(sorted(results),
+                             ['a', 'b', ('bad', 'bad file'),
+                              ('gone', 'Worker process died')])
+            # Restarted after losing a task
+            self.assertTrue(pool.broken)
+            pool.get(2)
+            self.assertFalse(pool.broken)
+            self.assertEqual(list(scheduler.imap_bounded(
+                pool, crash, [('c', 1)], 4)), ['c'])
+        finally:
+            pool.terminate()
+
+    def testFreeCores(self):
+        self.assertIsNone(scheduler.free_cores())
+        cpu_count = scheduler.cpu_count
+        scheduler.cpu_count = lambda: 4
+        pool = scheduler.WorkerPool()
+        try:
+            pool.get(2)
+            # Alone, so every other core is free
+            self.assertEqual(list(scheduler.imap_bounded(
+                pool, free_cores, [('a', 1)], 4)), [3])
+        finally:
+            pool.terminate()
+            scheduler.cpu_count = cpu_count
+
+
+if __name__ == '__main__':
+    unittest.main()